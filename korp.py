@@ -13,7 +13,12 @@ if "gunicorn" not in os.environ.get("SERVER_SOFTWARE", ""):
     from gevent import monkey
     monkey.patch_all(subprocess=False)  # Patching needs to be done as early as possible, before other imports
 
+import gevent
+import gevent.monkey
+import gevent.subprocess
+import gevent.threadpool
 from gevent.pywsgi import WSGIServer
+from gevent.pool import Pool
 from gevent.threadpool import ThreadPool
 from gevent.queue import Queue, Empty
 
@@ -33,9 +38,14 @@ from typing import Union, Optional
 import datetime
 import uuid
 import binascii
+import bisect
 import sys
 import glob
+import io
+import tempfile
 import time
+import signal
+import socket
 import re
 import json
 import zlib
@@ -44,11 +54,17 @@ import urllib.parse
 import urllib.error
 import base64
 import hashlib
+import array
+import heapq
+import locale
 import itertools
 import traceback
 import functools
+import contextlib
+import threading
 import math
 import random
+import numpy
 import korppluginlib
 import config
 import yaml
@@ -59,8 +75,18 @@ except ImportError:
     cache_disabled = True
 else:
     cache_disabled = False
-from flask import Flask, request, Response, stream_with_context, copy_current_request_context
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from flask import Flask, request, Response, stream_with_context, copy_current_request_context, has_request_context
 from flask_mysqldb import MySQL
+import MySQLdb
+import MySQLdb.cursors
 from flask_cors import CORS
 
 ################################################################################
@@ -80,6 +106,19 @@ IS_IDENT = re.compile(r"^[\w\-,|]+$")
 
 QUERY_DELIM = ","
 
+# Number of bits used for the row id when packing word picture source ids together with a corpus index
+RELATIONS_SOURCE_ID_BITS = 40
+
+# Number of list or dict items to encode at a time when streaming JSON output
+JSON_STREAM_ITEMS = 100
+
+# Delay in seconds before retrying to load a lemgram index for /lemgram_count after a failure
+LEMGRAM_INDEX_RETRY_DELAY = 300
+
+# Max delay in seconds before restarting a crashed server process, the delay doubling with each crash of a process that
+# ran for a shorter time than this
+WORKER_RESTART_DELAY_MAX = 60
+
 ################################################################################
 
 app = Flask(__name__)
@@ -104,6 +143,8 @@ def main_handler(generator):
      - callback: an identifier that the result should be wrapped in
      - encoding: the encoding for interacting with the corpus (default: UTF-8)
      - indent: pretty-print the result with a specific indentation
+     - format: "json" (default), or "ndjson" or "msgpack" for a stream of records (one JSON object per line, or
+       MessagePack objects), with KWIC rows and count rows as separate records
      - debug: if set, return some extra information (for debugging)
     """
     @functools.wraps(generator)  # Copy original function's information, needed by Flask
@@ -160,20 +201,20 @@ def main_handler(generator):
                         else:
                             response = plugin_caller.filter_value(
                                 "filter_result", response)
-                            output = json.dumps(response)[1:-1] + ",\n"
-                            result_len += len(output)
-                            yield output
+                            for output in json_stream_members(response):
+                                result_len += len(output)
+                                yield output
                 except GeneratorExit:
                     raise
                 except:
                     error = error_handler()
-                    output = json.dumps(error)[1:-1] + ",\n"
+                    output = json_encode(error)[1:-1] + ",\n"
                     result_len += len(output)
                     yield output
 
                 endtime = time.time()
                 elapsed_time = endtime - starttime
-                output = json.dumps({"time": elapsed_time})[1:] + "\n"
+                output = json_encode({"time": elapsed_time})[1:] + "\n"
                 result_len += len(output)
                 yield output
                 if callback:
@@ -204,16 +245,57 @@ def main_handler(generator):
                 result["time"] = elapsed_time
 
                 result = plugin_caller.filter_value("filter_result", result)
+                nonlocal result_error
+                result_error = "ERROR" in result
 
+                # Encode large results piece by piece directly into the response
+                result_len = 0
                 if callback:
-                    result = callback + "(" + json.dumps(result, indent=indent) + ")"
-                else:
-                    result = json.dumps(result, indent=indent)
+                    result_len += len(callback) + 1
+                    yield callback + "("
+                for output in json_stream(result, indent=indent):
+                    result_len += len(output)
+                    yield output
+                if callback:
+                    result_len += 1
+                    yield ")"
                 plugin_caller.raise_event(
-                    "exit_handler", endtime, elapsed_time, len(result))
-                yield result
+                    "exit_handler", endtime, elapsed_time, result_len)
                 plugin_caller.cleanup()
 
+            def record_output(ff):
+                """Yield the result as a custom response streaming records in the requested format.
+
+                The filter_result plugin hook is applied to each record.
+                """
+                if output_format == "msgpack" and msgpack is None:
+                    raise ValueError("MessagePack output is not available")
+
+                def encode(record):
+                    record = plugin_caller.filter_value("filter_result", record)
+                    if output_format == "msgpack":
+                        return msgpack.packb(record, use_bin_type=True)
+                    return json_encode(record) + "\n"
+
+                def records():
+                    try:
+                        for response in ff:
+                            if not response:
+                                # Yield an empty line to prevent timeout (not possible with MessagePack)
+                                if output_format == "ndjson":
+                                    yield "\n"
+                            else:
+                                for record in result_records(response):
+                                    yield encode(record)
+                    except GeneratorExit:
+                        raise
+                    except:
+                        yield encode(error_handler())
+                    yield encode({"time": time.time() - starttime})
+
+                yield {"content": records(),
+                       "mimetype": "application/x-msgpack" if output_format == "msgpack" else "application/x-ndjson"}
+
             def make_custom_response(ff):
                 """Return a Response with custom mimetype and/or headers.
 
@@ -224,6 +306,9 @@ def main_handler(generator):
                 - "headers": possible other headers as a list of pairs
                   (header, value).
 
+                The content may also be an iterator, in which case it is
+                streamed and not filtered as a whole.
+
                 Note that setting incremental=True does not have any effect.
                 """
                 result = {}
@@ -235,10 +320,25 @@ def main_handler(generator):
                     raise
                 except:
                     # Return error information as JSON
-                    result["content"] = json.dumps(error_handler(),
-                                                   indent=indent)
+                    result["content"] = json_encode(error_handler(),
+                                                    indent=indent)
                     result["mimetype"] = "application/json"
 
+                if not isinstance(result["content"], (str, bytes)):
+                    def stream(content):
+                        content_len = 0
+                        for chunk in content:
+                            content_len += len(chunk)
+                            yield chunk
+                        endtime = time.time()
+                        plugin_caller.raise_event(
+                            "exit_handler", endtime, endtime - starttime, content_len)
+                        plugin_caller.cleanup()
+
+                    return Response(stream_with_context(stream(result["content"])),
+                                    headers=result.get("headers"),
+                                    mimetype=result.get("mimetype"))
+
                 # Filter only the content. Should we also allow filtering the
                 # headers and/or mimetype, using separate hook points?
                 result["content"] = plugin_caller.filter_value(
@@ -259,19 +359,64 @@ def main_handler(generator):
             args = plugin_caller.filter_value("filter_args", args)
             incremental = parse_bool(args, "incremental", False)
             callback = args.get("callback")
-            indent = int(args.get("indent", 0))
-
-            if getattr(generator, "use_custom_headers", None):
-                # Custom headers and/or MIME type (non-JSON)
-                return make_custom_response(generator(args, *pargs, **kwargs))
-            elif incremental:
-                # Incremental response
-                return Response(stream_with_context(incremental_json(generator(args, *pargs, **kwargs))),
-                                mimetype="application/json")
-            else:
-                # We still use a streaming response even when non-incremental, to prevent timeouts
-                return Response(stream_with_context(full_json(generator(args, *pargs, **kwargs))),
-                                mimetype="application/json")
+            indent = int(args.get("indent", 0)) or None
+            output_format = args.get("format", "json")
+
+            headers = None
+            # Set by full_json() when the result is ready
+            result_error = None
+            if getattr(generator, "etag_versions", None) and request.method in ("GET", "HEAD"):
+                headers = conditional_get_headers(args, generator.etag_versions)
+                if headers and request.if_none_match.contains_weak(headers["ETag"][3:-1]):
+                    # The client already has the current result
+                    endtime = time.time()
+                    plugin_caller.raise_event("exit_handler", endtime, endtime - starttime, 0)
+                    plugin_caller.cleanup()
+                    return Response(status=304, headers=headers)
+
+            limiter = get_admission_limiter(request.endpoint)
+            slots = 0
+            if limiter:
+                slots = limiter.acquire(request_cost(args))
+                if not slots:
+                    # Rather reject the request right away than let it slow down all the others
+                    endtime = time.time()
+                    plugin_caller.raise_event("exit_handler", endtime, endtime - starttime, 0)
+                    plugin_caller.cleanup()
+                    return Response(json_encode(admission_error(request.path), indent=indent), status=503,
+                                    mimetype="application/json",
+                                    headers={"Retry-After": str(config.ADMISSION_RETRY_AFTER)})
+
+            try:
+                if getattr(generator, "use_custom_headers", None):
+                    # Custom headers and/or MIME type (non-JSON)
+                    response = make_custom_response(generator(args, *pargs, **kwargs))
+                elif output_format in ("ndjson", "msgpack"):
+                    # Stream of records, output as they are produced
+                    response = make_custom_response(record_output(generator(args, *pargs, **kwargs)))
+                elif incremental:
+                    # Incremental response. An error could still follow the first results, so it can't be cached.
+                    response = json_response(incremental_json(generator(args, *pargs, **kwargs)))
+                elif headers:
+                    # Wait for the first output before sending the headers, and only make the result cacheable if it
+                    # is complete without errors. Results slower than KEEPALIVE_INTERVAL start with whitespace sent
+                    # without the ETag, as it isn't known yet whether they will contain an error.
+                    output = full_json(generator(args, *pargs, **kwargs))
+                    first = next(output)
+                    if result_error is not False:
+                        headers = None
+                    response = json_response(itertools.chain([first], output), headers)
+                else:
+                    # We still use a streaming response even when non-incremental, to prevent timeouts
+                    response = json_response(full_json(generator(args, *pargs, **kwargs)))
+            except:
+                if slots:
+                    limiter.release(slots)
+                raise
+            if slots:
+                # The request keeps its slots until the streamed response has been sent
+                response.call_on_close(functools.partial(limiter.release, slots))
+            return response
 
     return decorated
 
@@ -290,7 +435,7 @@ def prevent_timeout(generator):
                 queue.put(response)
             queue.put("DONE")
 
-        timeout = 15
+        timeout = config.KEEPALIVE_INTERVAL
         q = Queue()
 
         @copy_current_request_context
@@ -300,8 +445,11 @@ def prevent_timeout(generator):
             except Exception as e:
                 q.put(sys.exc_info())
 
-        pool = ThreadPool(1)
-        pool.spawn(error_catcher, f, q)
+        if cooperative_io():
+            # Blocking I/O only suspends the greenlet, so no thread is needed
+            gevent.spawn(error_catcher, f, q)
+        else:
+            worker_pool.spawn(error_catcher, f, q)
 
         while True:
             try:
@@ -318,6 +466,345 @@ def prevent_timeout(generator):
     return decorated
 
 
+class WorkerPool:
+    """A bounded pool of native threads shared by all requests, running the view functions using prevent_timeout.
+
+    Tasks wait in a queue when all threads are busy. The pool must only be used from the thread running the gevent
+    hub, i.e. from request handlers.
+    """
+
+    def __init__(self, size):
+        self.size = max(size, 1)
+        self._pool = None
+        self._stats = {"tasks": 0, "queued": 0, "running_max": 0, "wait_time_total": 0.0, "wait_time_max": 0.0}
+
+    def spawn(self, func, *args):
+        """Run func(*args) in a pool thread as soon as one is free, without waiting for it."""
+        if self._pool is None:
+            # Created on first use, so that each (forked) server process gets its own threads
+            self._pool = ThreadPool(self.size)
+        gevent.spawn(self._run, func, args)
+
+    def _run(self, func, args):
+        # All bookkeeping is done in this greenlet, in the hub thread, so no locking is needed
+        stats = self._stats
+        stats["tasks"] += 1
+        stats["queued"] += 1
+        queued_time = time.time()
+        try:
+            # Waits for a free thread
+            self._pool.spawn(func, *args)
+        finally:
+            stats["queued"] -= 1
+        wait_time = time.time() - queued_time
+        stats["wait_time_total"] += wait_time
+        stats["wait_time_max"] = max(stats["wait_time_max"], wait_time)
+        stats["running_max"] = max(stats["running_max"], self.running())
+
+    def running(self):
+        """Return the number of tasks running."""
+        if self._pool is None:
+            return 0
+        # The unfinished tasks in the thread pool are the running ones (and possibly one just finishing), as tasks are
+        # only added when a thread is free
+        return min(len(self._pool), self.size)
+
+    def stats(self):
+        """Return pool utilization and queue wait statistics."""
+        stats = dict(self._stats, size=self.size, running=self.running())
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["tasks"] if stats["tasks"] else 0.0
+        return stats
+
+
+class AdmissionLimiter:
+    """Limits the requests to an endpoint running at the same time and waiting for their turn.
+
+    Each running request takes a number of slots given by its estimated cost, at most size slots being taken at the same
+    time. At most queue_size requests (None = no limit) wait for free slots, each at most timeout seconds.
+    """
+
+    def __init__(self, size, queue_size=None, timeout=None):
+        self.size = max(size, 1)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._used = 0
+        self._waiting = 0
+        # Unpatched, so that the limiter also works in native threads
+        self._cond = gevent.monkey.get_original("threading", "Condition")()
+        self._wait_pool = None
+        self._stats = {"admitted": 0, "rejected": 0, "timeouts": 0, "wait_time_max": 0.0}
+
+    def acquire(self, cost=1):
+        """Take slots for a request of the given cost, waiting for them if needed.
+
+        Return the number of slots taken, to be given to release(), or 0 if the request was rejected.
+        """
+        cost = min(max(cost, 1), self.size)
+        starttime = time.time()
+        with self._cond:
+            if self._used + cost <= self.size:
+                return self._admit(cost, starttime)
+            if self.queue_size is not None and self._waiting >= self.queue_size:
+                self._stats["rejected"] += 1
+                return 0
+            self._waiting += 1
+        if gevent.get_hub().loop.default:
+            # Waiting on the native condition would block all the greenlets, so wait in a thread of our own
+            if not self._wait_pool:
+                self._wait_pool = ThreadPool(self.queue_size or config.WORKER_THREADS)
+            return self._wait_pool.apply(self._wait, (cost, starttime))
+        return self._wait(cost, starttime)
+
+    def _wait(self, cost, starttime):
+        """Wait for the slots of a request counted as waiting by acquire(), and take them if they got free in time."""
+        timeout = None if self.timeout is None else max(self.timeout - (time.time() - starttime), 0)
+        with self._cond:
+            admitted = self._cond.wait_for(lambda: self._used + cost <= self.size, timeout)
+            self._waiting -= 1
+            if not admitted:
+                self._stats["timeouts"] += 1
+                return 0
+            return self._admit(cost, starttime)
+
+    def _admit(self, cost, starttime):
+        """Take the slots of a request, with self._cond held."""
+        self._used += cost
+        self._stats["admitted"] += 1
+        self._stats["wait_time_max"] = max(self._stats["wait_time_max"], time.time() - starttime)
+        return cost
+
+    def release(self, cost):
+        """Free the slots taken by acquire()."""
+        with self._cond:
+            self._used -= cost
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return slot usage and rejection statistics."""
+        with self._cond:
+            return dict(self._stats, size=self.size, used=self._used, waiting=self._waiting)
+
+
+# Admission limiters of the endpoints, None for endpoints without limits: endpoint -> AdmissionLimiter
+admission_limiters = {}
+
+# Corpus sizes in tokens seen in /corpus_info results, for estimating the cost of requests: corpus -> size
+corpus_sizes = {}
+
+
+def get_admission_limiter(endpoint):
+    """Return the AdmissionLimiter of endpoint, or None if ADMISSION_LIMITS has no limits for the endpoint."""
+    if endpoint not in admission_limiters:
+        limits = config.ADMISSION_LIMITS.get(endpoint, config.ADMISSION_LIMITS.get("default"))
+        admission_limiters[endpoint] = (AdmissionLimiter(*limits, timeout=config.ADMISSION_QUEUE_TIMEOUT)
+                                        if limits else None)
+    return admission_limiters[endpoint]
+
+
+def admission_error(path):
+    """Return the error for a request to path rejected by its AdmissionLimiter."""
+    return {"ERROR": {"type": "ServiceUnavailable",
+                      "value": "Too many requests to %s, please try again later." % path}}
+
+
+def request_cost(args):
+    """Return the estimated cost of a request: the total size of its corpora in units of ADMISSION_COST_UNIT tokens.
+
+    Corpora of unknown size count as empty, but the cost is always at least 1.
+    """
+    size = sum(corpus_sizes.get(corpus.split("|")[0], 0) for corpus in parse_corpora(args))
+    return max(math.ceil(size / config.ADMISSION_COST_UNIT), 1)
+
+
+def note_corpus_sizes(corpora_info):
+    """Record the corpus sizes in corpora_info, the "corpora" of a /corpus_info result."""
+    for corpus, data in corpora_info.items():
+        size = data["info"].get("Size", "")
+        if size.isdigit():
+            corpus_sizes[corpus] = int(size)
+
+
+def admission_stats():
+    """Return the statistics of the admission limiters in use."""
+    return {endpoint: limiter.stats() for endpoint, limiter in admission_limiters.items() if limiter}
+
+
+def cooperative_io():
+    """Return True if COOPERATIVE_IO is enabled and we are in the thread running the main gevent hub.
+
+    CQP subprocesses and database queries then only block the current greenlet. gevent's subprocess module can't be used
+    in other threads, which always use blocking I/O.
+    """
+    return config.COOPERATIVE_IO and gevent.get_hub().loop.default
+
+
+def popen(args, **kwargs):
+    """Start a subprocess, with cooperative pipes if cooperative_io() is True."""
+    if cooperative_io():
+        return gevent.subprocess.Popen(args, **kwargs)
+    return subprocess.Popen(args, **kwargs)
+
+
+def db_call(func, *args):
+    """Call the blocking database client function func, in the gevent hub's thread pool if cooperative_io() is True."""
+    if cooperative_io():
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+def native_lock():
+    """Return a lock that can be shared by native threads, also when threading has been monkey patched."""
+    return gevent.monkey.get_original("threading", "Lock")()
+
+
+def json_response(output, headers=None):
+    """Return a streaming JSON Response of the output chunks, compressed if the client accepts it."""
+    headers = dict(headers or {})
+    encoding = None
+    if config.COMPRESSION_LEVEL:
+        encoding = request.accept_encodings.best_match(["gzip", "deflate"])
+    if not encoding:
+        return Response(stream_with_context(output), mimetype="application/json", headers=headers)
+    headers.update({"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+    return Response(stream_with_context(compress_stream(output, encoding)), mimetype="application/json",
+                    headers=headers)
+
+
+def compress_stream(output, encoding="gzip"):
+    """Compress the output chunks with gzip or deflate, yielding compressed data as it becomes available.
+
+    Chunks ending with a newline, i.e. keepalive whitespace and incremental results, are flushed to the client right
+    away.
+    """
+    # deflate in HTTP means the zlib format
+    compressor = zlib.compressobj(config.COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  zlib.MAX_WBITS + 16 if encoding == "gzip" else zlib.MAX_WBITS)
+    for chunk in output:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if chunk.endswith("\n"):
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def json_encode(obj, indent=None):
+    """Encode obj as JSON, pretty-printed with the given indentation if indent is set.
+
+    orjson is used if it is installed, enabled in JSON_ENCODER and supports the indentation, and json otherwise.
+    """
+    if orjson is not None and config.JSON_ENCODER == "orjson" and indent in (None, 2):
+        try:
+            return orjson.dumps(obj, option=(orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY |
+                                             (orjson.OPT_INDENT_2 if indent else 0))).decode("utf-8")
+        except (orjson.JSONEncodeError, TypeError):
+            # For example integers too large for orjson
+            pass
+    return json.dumps(obj, indent=indent)
+
+
+def json_encode_key(key):
+    """Encode the dict key as a JSON string, converting non-string keys the same way as json.dumps() does."""
+    return json_encode(key if isinstance(key, str) else json.dumps(key))
+
+
+def json_stream(obj, indent=None, level=0):
+    """Encode obj as JSON and yield it in pieces, encoding JSON_STREAM_ITEMS list or dict items at a time.
+
+    Dicts with lists or dicts as values are encoded one value at a time, recursively. The output is the same as that
+    of json_encode() except for the whitespace between pieces. level is the nesting level of obj, for indentation.
+    """
+    if not obj or not isinstance(obj, (dict, list)) or (isinstance(obj, list) and len(obj) <= JSON_STREAM_ITEMS):
+        yield json_indent(json_encode(obj, indent=indent), indent, level)
+        return
+
+    newline = "\n" + " " * (indent * (level + 1)) if indent is not None else ""
+    start, end = ("{", "}") if isinstance(obj, dict) else ("[", "]")
+    yield start
+    if isinstance(obj, dict) and any(isinstance(v, (dict, list)) for v in obj.values()):
+        for i, (key, value) in enumerate(obj.items()):
+            yield ("," if i else "") + newline + json_encode_key(key) + ": "
+            yield from json_stream(value, indent=indent, level=level + 1)
+    else:
+        items = list(obj.items()) if isinstance(obj, dict) else obj
+        for i in range(0, len(items), JSON_STREAM_ITEMS):
+            chunk = items[i:i + JSON_STREAM_ITEMS]
+            chunk = json_encode(dict(chunk) if isinstance(obj, dict) else chunk, indent=indent)
+            # Remove the brackets, and the newline after the opening bracket if pretty-printing
+            chunk = chunk[2:-2] if indent is not None else chunk[1:-1]
+            yield ("," if i else "") + newline + json_indent(chunk.lstrip(" "), indent, level)
+    yield ("\n" + " " * (indent * level) if indent is not None else "") + end
+
+
+def json_indent(output, indent, level):
+    """Indent the lines of pretty-printed JSON output after the first one to the given nesting level."""
+    if indent and level:
+        return output.replace("\n", "\n" + " " * (indent * level))
+    return output
+
+
+def result_records(result):
+    """Split a result into records for the ndjson and msgpack output formats.
+
+    Each KWIC row and each row of a count result is a record of its own. Count rows get the corpus in "corpus" (except
+    for the combined rows) and the index of the subquery in "subquery" if there are subqueries. The rest of the result
+    is the last record, if there is anything left.
+    """
+    rest = dict(result)
+
+    if isinstance(rest.get("kwic"), list):
+        yield from rest.pop("kwic")
+
+    if "combined" in rest:
+        rest["combined"], records = split_count_stats(rest["combined"])
+        yield from records
+    if isinstance(rest.get("corpora"), dict):
+        corpora = {}
+        for corpus, stats in rest["corpora"].items():
+            corpora[corpus], records = split_count_stats(stats, corpus)
+            yield from records
+        rest["corpora"] = corpora
+
+    if rest:
+        yield rest
+
+
+def split_count_stats(stats, corpus=None):
+    """Split count stats (a list of them for subqueries) into the stats without rows and an iterator over the rows as
+    records, for result_records()."""
+    subqueries = isinstance(stats, list)
+    stats_rows = []
+    stats_list = []
+    for i, query_stats in enumerate(stats if subqueries else [stats]):
+        if isinstance(query_stats, dict) and isinstance(query_stats.get("rows"), list):
+            stats_rows.append((i, query_stats["rows"]))
+            query_stats = dict((k, v) for k, v in query_stats.items() if k != "rows")
+        stats_list.append(query_stats)
+
+    def records():
+        for i, rows in stats_rows:
+            for row in rows:
+                record = dict(row)
+                if corpus:
+                    record["corpus"] = corpus
+                if subqueries:
+                    record["subquery"] = i
+                yield record
+
+    return stats_list if subqueries else stats_list[0], records()
+
+
+def json_stream_members(obj):
+    """Yield the members of the JSON object of dict obj without the enclosing braces, each member followed by a comma
+    and a newline, for incremental output."""
+    for key, value in obj.items():
+        output = json_encode_key(key) + ": "
+        for output_part in json_stream(value):
+            yield output + output_part
+            output = ""
+        yield ",\n"
+
+
 def use_custom_headers(generator):
     """Decorator for view functions possibly yielding a non-JSON result.
 
@@ -331,6 +818,79 @@ def use_custom_headers(generator):
     return generator
 
 
+def use_etag(versions):
+    """Decorator for view functions whose result only depends on the arguments and on the versions of some data.
+
+    versions is a function returning the versions for the arguments of a request, for example with
+    corpora_versions(). The response then gets an ETag based on the arguments and versions, and a GET request with a
+    matching If-None-Match header is answered with 304 without calling the view function. Requests for protected
+    corpora are always handled normally.
+    """
+    def decorator(generator):
+        generator.etag_versions = versions
+        return generator
+    return decorator
+
+
+def conditional_get_headers(args, versions):
+    """Return the ETag and Cache-Control headers for a request to a view function decorated with use_etag().
+
+    Return None if the versions can't be determined, in which case the request is handled normally. Also return None
+    if any of the corpora is protected, or if authentication may depend on plugins, so that the access rights of the
+    user are always checked and the result is not stored in shared caches.
+    """
+    try:
+        versions = versions(args)
+    except Exception:
+        # Let the view function report invalid arguments
+        return None
+    if korppluginlib.KorpCallbackPluginCaller.get_instance().has_callbacks("filter_auth_postdata"):
+        return None
+    corpora = parse_corpora(args)
+    if corpora:
+        protected = get_protected_corpora()
+        if any(cc.upper() in protected for c in corpora for cc in c.split("|")):
+            return None
+    authorization = request.headers.get("Authorization")
+    etag = get_hash((KORP_VERSION, request.path, sorted((k, str(v)) for k, v in args.items()), authorization,
+                     versions))
+    return {"ETag": 'W/"%s"' % etag,
+            "Cache-Control": "%s, max-age=%d" % ("private" if authorization else "public", config.CACHE_MAX_AGE)}
+
+
+def corpora_versions(args):
+    """Return the versions of the corpora in the arguments, for use_etag()."""
+    return [get_corpus_version(corpus, args["cache"]) for corpus in parse_corpora(args)]
+
+
+def timespan_versions(args):
+    """Return the versions of the corpora in the arguments and of their timedata, for use_etag()."""
+    versions = corpora_versions(args)
+    if config.TIMEDATA_DIR:
+        for corpus in parse_corpora(args):
+            for table in ("timedata", "timedata_date"):
+                path = timedata_store_path(corpus, table)
+                versions.append(os.path.getmtime(path) if os.path.exists(path) else None)
+    return versions
+
+
+def info_versions(args):
+    """Return the versions of the list of corpora and protected corpora, for use_etag()."""
+    versions = [os.path.getmtime(config.CWB_REGISTRY)]
+    if config.PROTECTED_FILE and os.path.exists(config.PROTECTED_FILE):
+        versions.append(os.path.getmtime(config.PROTECTED_FILE))
+    if args["cache"]:
+        versions.append(cache_prefix())
+    return versions
+
+
+def corpus_config_versions(args):
+    """Return the version of the corpus configuration, for use_etag()."""
+    if args["cache"]:
+        return [cache_prefix(config=True)]
+    return get_corpus_config_timestamps()
+
+
 ################################################################################
 # ARGUMENT PARSING
 ################################################################################
@@ -383,6 +943,7 @@ def sleep(args):
 @app.route("/")
 @app.route("/info", methods=["GET", "POST"])
 @main_handler
+@use_etag(info_versions)
 def info(args):
     """Get version information about list of available corpora."""
     strict = parse_bool(args, "strict", False)
@@ -393,6 +954,9 @@ def info(args):
             if "debug" in args:
                 result.setdefault("DEBUG", {})
                 result["DEBUG"]["cache_read"] = True
+                result["DEBUG"]["sql_pool"] = sql_pool.stats()
+                result["DEBUG"]["worker_pool"] = worker_pool.stats()
+                result["DEBUG"]["admission"] = admission_stats()
             yield result
             return
 
@@ -422,11 +986,18 @@ def info(args):
             result.setdefault("DEBUG", {})
             result["DEBUG"]["cache_saved"] = True
 
+    if "debug" in args:
+        result.setdefault("DEBUG", {})
+        result["DEBUG"]["sql_pool"] = sql_pool.stats()
+        result["DEBUG"]["worker_pool"] = worker_pool.stats()
+        result["DEBUG"]["admission"] = admission_stats()
+
     yield result
 
 
 @app.route("/corpus_info", methods=["GET", "POST"])
 @main_handler
+@use_etag(corpora_versions)
 def corpus_info(args, no_combined_cache=False):
     """Get information about a specific corpus or corpora."""
     assert_key("corpus", args, IS_IDENT, True)
@@ -448,6 +1019,7 @@ def corpus_info(args, no_combined_cache=False):
                 result.setdefault("DEBUG", {})
                 result["DEBUG"]["cache_read"] = True
                 result["DEBUG"]["checksum"] = checksum_combined
+            note_corpus_sizes(result["corpora"])
             yield result
             return
 
@@ -531,6 +1103,7 @@ def corpus_info(args, no_combined_cache=False):
                 if saved and "debug" in args:
                     result.setdefault("DEBUG", {})
                     result["DEBUG"]["cache_saved"] = True
+    note_corpus_sizes(result["corpora"])
     yield result
 
 
@@ -644,6 +1217,7 @@ def query(args):
     assert_key("cut", args, IS_NUMBER)
     assert_key("sort", args, r"")
     assert_key("incremental", args, r"(true|false)")
+    assert_key("global_sort", args, r"(true|false)")
 
     incremental = parse_bool(args, "incremental", False)
     free_search = not parse_bool(args, "in_order", True)
@@ -696,6 +1270,11 @@ def query(args):
 
     sort = args.get("sort")
     sort_random_seed = args.get("random_seed")
+    global_sort = bool(sort) and sort != "random" and parse_bool(args, "global_sort", False)
+    if global_sort and free_search:
+        raise ValueError("global_sort cannot be used with in_order=false.")
+    if global_sort and config.SORTED_HITS_MAX and end >= config.SORTED_HITS_MAX:
+        raise ValueError("With global_sort, at most the first %d hits can be returned." % config.SORTED_HITS_MAX)
 
     # Sort numbered CQP-queries numerically
     cqp, _ = parse_cqp_subcqp(args)
@@ -777,7 +1356,65 @@ def query(args):
     else:
         complete_hits = False
 
-    if complete_hits:
+    if global_sort:
+        # Sort the hits of all corpora together: merge the sorted hits of each corpus to find the hits on the
+        # requested page, and then get the KWIC rows of those hits from each corpus in parallel.
+        if incremental:
+            yield {"progress_corpora": corpora}
+        ns.progress_count = 0
+        corpora_sorted_hits = {}
+
+        with ThreadPoolExecutor(max_workers=config.PARALLEL_THREADS) as executor:
+            future_query = dict(
+                (executor.submit(get_sorted_hits, corpus, cqp, end + 1, within=within[corpus], cut=cut, show=show,
+                                 show_structs=show_structs, sort=sort, expand_prequeries=expand_prequeries,
+                                 use_cache=use_cache, request=request._get_current_object()),
+                 corpus)
+                for corpus in corpora)
+
+            for future in futures.as_completed(future_query):
+                corpus = future_query[future]
+                if future.exception() is not None:
+                    raise CQPError(future.exception())
+                else:
+                    corpora_sorted_hits[corpus] = future.result()
+                    nr_hits = len(corpora_sorted_hits[corpus])
+                    statistics[corpus] = nr_hits
+                    ns.total_hits += nr_hits
+                    if incremental:
+                        yield {"progress_%d" % ns.progress_count: {"corpus": corpus, "hits": nr_hits}}
+                        ns.progress_count += 1
+
+        # Corpus -> list of (index on page, index of hit in the sorted query result)
+        corpora_rows = defaultdict(list)
+        # Equal keys are ordered by corpus order
+        merged = heapq.merge(*(zip(corpora_sorted_hits[corpus].keys, itertools.repeat(i), itertools.count())
+                               for i, corpus in enumerate(corpora)))
+        for page_index, (_, i, rank) in enumerate(itertools.islice(merged, start, end + 1)):
+            corpora_rows[corpora[i]].append((page_index, rank))
+
+        kwic = [None] * sum(len(rows) for rows in corpora_rows.values())
+        with ThreadPoolExecutor(max_workers=config.PARALLEL_THREADS) as executor:
+            future_query = dict(
+                (executor.submit(query_and_parse, corpus, within=within[corpus], context=context[corpus],
+                                 rows=[row for _, row in corpora_rows[corpus]],
+                                 request=request._get_current_object(),
+                                 **dict(queryparams, sort=sort)),
+                 corpus)
+                for corpus in corpora_rows)
+
+            for future in futures.as_completed(future_query):
+                corpus = future_query[future]
+                if future.exception() is not None:
+                    raise CQPError(future.exception())
+                else:
+                    corpus_kwic, _ = future.result()
+                    if len(corpus_kwic) != len(corpora_rows[corpus]):
+                        raise CQPError("Could not read the hits of %s." % corpus)
+                    for (page_index, _), row in zip(corpora_rows[corpus], corpus_kwic):
+                        kwic[page_index] = row
+        result["kwic"] = kwic
+    elif complete_hits:
         # We have saved_statistics available for all corpora, so calculate which
         # corpora need to be queried and then query them in parallel.
         corpora_hits = which_hits(corpora, saved_statistics, start, end)
@@ -1041,8 +1678,10 @@ def query_optimize(cqp, cqpparams, find_match=True, expand=True, free_search=Fal
 def query_corpus(corpus, cqp, within=None, cut=None, context=None, show=None, show_structs=None, start=0, end=10,
                  sort=None, random_seed=None,
                  no_results=False, expand_prequeries=True, free_search=False, use_cache=False,
-                 request=request):
+                 request=request, rows=None, tabulate=None):
     # request is used only for passing to run_cqp
+    # rows is a list of indices of hits in the sorted result to show instead of start..end, and tabulate the range and
+    # fields to print for the sorted hits with the CQP tabulate command instead of the KWIC rows
     if use_cache:
         # Calculate checksum
         # Needs to contain all arguments that may influence the results
@@ -1171,7 +1810,11 @@ def query_corpus(corpus, cqp, within=None, cut=None, context=None, show=None, sh
     if use_cache and not is_cached:
         cmd += ["%s = Last; save %s;" % (cache_query_temp, cache_query_temp)]
 
-    if not no_results and not (use_cache and cached_no_hits):
+    if tabulate and not (use_cache and cached_no_hits):
+        cmd += ["set ExternalSort yes;"]
+        cmd += sortcmd
+        cmd += ["tabulate Last %s;" % tabulate]
+    elif not no_results and not (use_cache and cached_no_hits):
         if free_search and retcode == 0:
             tokens, _ = parse_cqp(cqp[-1])
             cmd += ["Last;"]
@@ -1189,7 +1832,9 @@ def query_corpus(corpus, cqp, within=None, cut=None, context=None, show=None, sh
             cmd += ["set PrintStructures '%s';" % ", ".join(show_structs)]
         cmd += ["set ExternalSort yes;"]
         cmd += sortcmd
-        if free_search:
+        if rows is not None:
+            cmd += ["cat Last %d %d;" % (row, row) for row in rows]
+        elif free_search:
             cmd += ["cat Last;"]
         else:
             cmd += ["cat Last %s %s;" % (start, end)]
@@ -1392,11 +2037,11 @@ def query_parse_lines(corpus, lines, attrs, show, show_structs, free_matches=Fal
 
 def query_and_parse(corpus, cqp, within=None, cut=None, context=None, show=None, show_structs=None, start=0, end=10,
                     sort=None, random_seed=None, no_results=False, expand_prequeries=True, free_search=False,
-                    use_cache=False, request=request):
+                    use_cache=False, request=request, rows=None):
     # request is used only for passing to run_cqp via query_corpus
     lines, nr_hits, attrs = query_corpus(corpus, cqp, within, cut, context, show, show_structs, start, end, sort,
                                          random_seed, no_results, expand_prequeries, free_search, use_cache,
-                                         request)
+                                         request, rows=rows)
     kwic = query_parse_lines(corpus, lines, attrs, show, show_structs, free_matches=free_search)
     return kwic, nr_hits
 
@@ -1418,18 +2063,118 @@ def which_hits(corpora, stats, start, end):
     return corpus_hits
 
 
+class SortedHits:
+    """The first hits of a query in one corpus in sort order, for merging with the sorted hits of other corpora.
+
+    keys are the collation keys of the first hits as sorted by CQP, and nr_hits the total number of hits in the corpus.
+    The index of a hit in keys is its index in the query result sorted with the same sort command.
+    """
+
+    def __init__(self, version, keys, nr_hits):
+        self.version = version
+        self.keys = keys
+        self.nr_hits = nr_hits
+
+    def __len__(self):
+        return self.nr_hits
+
+    def complete(self, count):
+        """Return True if keys contain the keys of the first count hits (or of all hits if there are fewer)."""
+        return len(self.keys) >= min(count, self.nr_hits)
+
+
+# In-process sorted hits for /query with global_sort: (corpus, query checksum, sort) -> SortedHits
+sorted_hits_cache = OrderedDict()
+sorted_hits_lock = native_lock()
+
+# Changes of the process-wide LC_COLLATE setting are made one at a time
+collate_lock = native_lock()
+
+
+def get_sorted_hits(corpus, cqp, count, within=None, cut=None, show=None, show_structs=None, sort=None,
+                    expand_prequeries=True, use_cache=False, request=request):
+    """Return the SortedHits of the first count hits of a query in corpus, sorted by CQP with the sort parameter of
+    /query (except "random").
+
+    The keys are the sorted strings of CQP (the words of the sort context joined with spaces), compared with the
+    LC_COLLATE collation also used by CQP, so that merging the keys of several corpora gives the order in which CQP
+    would sort the hits of all of them. The sorted hits are kept in process, so that further pages of the same query
+    are taken from them without sorting again.
+    """
+    key = (corpus, get_hash((cqp, within, cut, expand_prequeries)), sort)
+    version = get_corpus_version(corpus, use_cache)
+    with sorted_hits_lock:
+        hits = sorted_hits_cache.get(key)
+        if hits is not None and hits.version == version and hits.complete(count):
+            sorted_hits_cache.move_to_end(key)
+            return hits
+
+    # The same words as in the sort commands of query_corpus, in the same order
+    if sort == "left":
+        fields = "match[-1] word, match[-2] word, match[-3] word"
+    elif sort == "keyword":
+        fields = "match .. matchend word"
+    elif sort == "right":
+        fields = "matchend[1] word, matchend[2] word, matchend[3] word"
+    else:
+        fields = "match .. matchend %s" % sort
+
+    # The corpus position of the match comes first, so that no line is empty
+    lines, nr_hits, _ = query_corpus(corpus, cqp, within, cut, show=show, show_structs=show_structs, sort=sort,
+                                     expand_prequeries=expand_prequeries, use_cache=use_cache, request=request,
+                                     tabulate="0 %d match, %s" % (max(count, 1) - 1, fields))
+    keys = collation_keys(" ".join(field for field in line.split("\t")[1:] if field) for line in lines)
+    if len(keys) != min(count, nr_hits):
+        raise CQPError("Could not read the sort keys of the hits in %s." % corpus)
+
+    hits = SortedHits(version, keys, nr_hits)
+    with sorted_hits_lock:
+        sorted_hits_cache[key] = hits
+        while len(sorted_hits_cache) > config.SORTED_HITS_CACHE_SIZE:
+            sorted_hits_cache.popitem(last=False)
+    return hits
+
+
+def collation_keys(strings):
+    """Return the sort keys of strings in the LC_COLLATE collation also used by CQP, or the strings themselves, compared
+    by code point, if the locale is not available.
+
+    The locale is process-wide, so it is only set for the time of computing the keys.
+    """
+    with collate_lock:
+        previous = locale.setlocale(locale.LC_COLLATE)
+        try:
+            locale.setlocale(locale.LC_COLLATE, config.LC_COLLATE)
+        except locale.Error:
+            return list(strings)
+        try:
+            return [locale.strxfrm(string) for string in strings]
+        finally:
+            locale.setlocale(locale.LC_COLLATE, previous)
+
+
 @app.route("/struct_values", methods=["GET", "POST"])
 @main_handler
+@use_etag(corpora_versions)
 @prevent_timeout
 def struct_values(args):
     """Get all available values for one or more structural attributes."""
     assert_key("corpus", args, IS_IDENT, True)
     assert_key("struct", args, re.compile(r"^[\w_\d,>]+$"), True)
     assert_key("incremental", args, r"(true|false)")
+    assert_key("limit", args, IS_NUMBER)
+    assert_key("offset", args, IS_NUMBER)
 
     incremental = parse_bool(args, "incremental", False)
     include_count = parse_bool(args, "count", False)
 
+    # Filtering and paging of values, served from in-process value indexes
+    prefix = args.get("prefix", "")
+    contains = args.get("contains", "")
+    limit = int(args.get("limit") or 0)
+    offset = int(args.get("offset") or 0)
+    filtered = bool(prefix or contains or limit or offset)
+
     per_corpus = parse_bool(args, "per_corpus", True)
     combined = parse_bool(args, "combined", True)
     corpora = parse_corpora(args)
@@ -1450,24 +2195,54 @@ def struct_values(args):
 
     from_cache = set()  # Keep track of what has been read from cache
 
+    def merge_into(merged, d):
+        """Merge the values tree d into merged in place. Leaf lists are collected into sets, to be sorted
+        only once by finalize_merged()."""
+        for key, value in d.items():
+            if isinstance(value, dict):
+                merge_into(merged.setdefault(key, {}), value)
+            elif isinstance(value, int):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged.setdefault(key, set()).update(value)
+
+    def finalize_merged(merged):
+        """Convert the leaf sets of a tree built by merge_into() into sorted lists."""
+        for key, value in merged.items():
+            if isinstance(value, set):
+                merged[key] = sorted(value)
+            elif isinstance(value, dict):
+                finalize_merged(value)
+
+    indexes = {}
+    if filtered:
+        # Use the sorted value indexes already built for the current corpus versions
+        for corpus in corpora:
+            for struct in structs:
+                index = get_struct_values_index(corpus, struct, split, include_count, args["cache"])
+                if index is not None:
+                    indexes[(corpus, struct)] = index
+                    from_cache.add((corpus, struct))
+
     if args["cache"]:
-        all_cache = True
         for corpus in corpora:
             for struct in structs:
+                if (corpus, struct) in from_cache:
+                    continue
                 checksum = get_hash((corpus, struct, split, include_count))
                 with mc_pool.reserve() as mc:
                     data = mc.get("%s:struct_values_%s" % (cache_prefix(corpus), checksum))
                 if data is not None:
                     result["corpora"].setdefault(corpus, {})
                     result["corpora"][corpus][struct] = data
+                    if combined and not filtered:
+                        merge_into(result["combined"], {struct: data})
                     if "debug" in args:
                         result.setdefault("DEBUG", {"caches_read": []})
                         result["DEBUG"]["caches_read"].append("%s:%s" % (corpus, struct))
                     from_cache.add((corpus, struct))
-                else:
-                    all_cache = False
-    else:
-        all_cache = False
+
+    all_cache = all((corpus, struct) in from_cache for corpus in corpora for struct in structs)
 
     if not all_cache:
         ns.progress_count = 0
@@ -1491,12 +2266,8 @@ def struct_values(args):
                     vals_dict = {}
                     struct_list = struct.split(">")
 
-                    for line in lines:
-                        freq, val = line.lstrip().split(" ", 1)
-
+                    for freq, vals in lines:
                         if ">" in struct:
-                            vals = val.split("\t")
-
                             if split:
                                 vals = [[x for x in n.split("|") if x] if struct_list[i] in split and n else [n] for
                                         i, n in enumerate(vals)]
@@ -1509,7 +2280,7 @@ def struct_values(args):
                                 for i, n in enumerate(val):
                                     if include_count and i == len(val) - 1:
                                         prev.setdefault(n, 0)
-                                        prev[n] += int(freq)
+                                        prev[n] += freq
                                         break
                                     elif not include_count and i == len(val) - 1:
                                         prev.append(n)
@@ -1520,13 +2291,14 @@ def struct_values(args):
                                         prev.setdefault(n, {})
                                     prev = prev[n]
                         else:
+                            val = vals[0]
                             if struct in split:
                                 vals = [x for x in val.split("|") if x] if val else [""]
                             else:
                                 vals = [val]
                             for val in vals:
                                 if include_count:
-                                    corpus_stats[val] = int(freq)
+                                    corpus_stats[val] = freq
                                 else:
                                     corpus_stats.add(val)
 
@@ -1535,29 +2307,17 @@ def struct_values(args):
                     elif corpus_stats:
                         result["corpora"][corpus][struct] = corpus_stats if include_count else sorted(corpus_stats)
 
+                    if combined and not filtered and struct in result["corpora"][corpus]:
+                        # Merge into the combined result as soon as the corpus is done
+                        merge_into(result["combined"], {struct: result["corpora"][corpus][struct]})
+
                     if incremental:
                         yield {"progress_%d" % ns.progress_count: corpus}
                         ns.progress_count += 1
 
-    def merge(d1, d2):
-        merged = deepcopy(d1)
-        for key in d2:
-            if key in d1:
-                if isinstance(d1[key], dict) and isinstance(d2[key], dict):
-                    merged[key] = merge(d1[key], d2[key])
-                elif isinstance(d1[key], int):
-                    merged[key] += d2[key]
-                elif isinstance(d1[key], list):
-                    merged[key].extend(d2[key])
-                    merged[key] = sorted(set(merged[key]))
-            else:
-                merged[key] = d2[key]
-        return merged
-
-    if combined:
-        for corpus in result["corpora"]:
-            result["combined"] = merge(result["combined"], result["corpora"][corpus])
-    else:
+    if combined and not filtered:
+        finalize_merged(result["combined"])
+    elif not combined:
         del result["combined"]
 
     if args["cache"] and not all_cache:
@@ -1578,12 +2338,105 @@ def struct_values(args):
                         result["DEBUG"].setdefault("caches_saved", [])
                         result["DEBUG"]["caches_saved"].append("%s:%s" % (corpus, struct))
 
+    if filtered:
+        for corpus in corpora:
+            for struct in structs:
+                if (corpus, struct) not in indexes:
+                    indexes[(corpus, struct)] = add_struct_values_index(
+                        corpus, struct, split, include_count, args["cache"],
+                        result["corpora"][corpus].get(struct))
+
+        result["corpora"] = defaultdict(dict)
+        stop = offset + limit if limit else None
+        for struct in structs:
+            struct_indexes = [indexes[(corpus, struct)] for corpus in corpora]
+            if per_corpus:
+                for corpus, index in zip(corpora, struct_indexes):
+                    keys = list(itertools.islice(index.select(prefix, contains), offset, stop))
+                    if keys:
+                        result["corpora"][corpus][struct] = index.subset(keys)
+            if combined:
+                # Merge the sorted matching values of all corpora, skipping duplicates
+                merged_keys = (k for k, _ in itertools.groupby(
+                    heapq.merge(*(index.select(prefix, contains) for index in struct_indexes))))
+                keys = list(itertools.islice(merged_keys, offset, stop))
+                for index in struct_indexes:
+                    corpus_keys = [k for k in keys if k in index]
+                    if corpus_keys:
+                        merge_into(result["combined"], {struct: index.subset(corpus_keys)})
+        if combined:
+            finalize_merged(result["combined"])
+
     if not per_corpus:
         del result["corpora"]
 
     yield result
 
 
+class StructValuesIndex:
+    """Sorted index of the values of a structural attribute in a corpus.
+
+    For a hierarchy of attributes (e.g. text_author>text_title), the values of the first attribute are indexed.
+    """
+
+    def __init__(self, version, data):
+        self.version = version
+        # data is the per-corpus result of /struct_values: a sorted list of values, or a dict with values as keys
+        self.data = data or []
+        self.keys = self.data if isinstance(self.data, list) else sorted(self.data)
+
+    def __contains__(self, key):
+        if isinstance(self.data, dict):
+            return key in self.data
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def select(self, prefix="", contains=""):
+        """Iterate in sorted order over the values beginning with prefix and containing contains."""
+        keys = self.keys
+        if prefix:
+            start = bisect.bisect_left(keys, prefix)
+            values = itertools.takewhile(lambda k: k.startswith(prefix), (keys[i] for i in range(start, len(keys))))
+        else:
+            values = iter(keys)
+        if contains:
+            values = (k for k in values if contains in k)
+        return values
+
+    def subset(self, keys):
+        """Return the part of the data for the given keys, in the same format as the data."""
+        if isinstance(self.data, dict):
+            return {k: self.data[k] for k in keys}
+        return keys
+
+
+# In-process value indexes for /struct_values: (corpus, struct, split, count) -> StructValuesIndex
+struct_values_indexes = OrderedDict()
+struct_values_lock = native_lock()
+
+
+def get_struct_values_index(corpus, struct, split, include_count, use_cache=False):
+    """Return the value index for struct in corpus if it has been built for the current corpus version."""
+    key = (corpus, struct, tuple(split), include_count)
+    version = get_corpus_version(corpus, use_cache)
+    with struct_values_lock:
+        index = struct_values_indexes.get(key)
+        if index is None or index.version != version:
+            return None
+        struct_values_indexes.move_to_end(key)
+    return index
+
+
+def add_struct_values_index(corpus, struct, split, include_count, use_cache, data):
+    """Build and store a value index for struct in corpus from its /struct_values data."""
+    index = StructValuesIndex(get_corpus_version(corpus, use_cache), data)
+    with struct_values_lock:
+        struct_values_indexes[(corpus, struct, tuple(split), include_count)] = index
+        while len(struct_values_indexes) > config.STRUCT_VALUES_INDEX_SIZE:
+            struct_values_indexes.popitem(last=False)
+    return index
+
+
 ################################################################################
 # COUNT
 ################################################################################
@@ -1754,18 +2607,23 @@ def count(args):
 
                 query_no = 0
                 for line in lines:
-                    if line == END_OF_LINE:
+                    if isinstance(line, tuple):
+                        # Already parsed by count_query_worker_simple
+                        freq, ngram_groups = line
+                    elif line == END_OF_LINE:
                         # EOL means the start of a new subcqp result
                         query_no += 1
                         if subcqp:
                             corpus_stats[query_no]["cqp"] = subcqp[query_no - 1]
                         continue
-                    freq, ngram = line.lstrip().split(" ", 1)
-
-                    if len(group_by) > 1:
-                        ngram_groups = ngram.split("\t")
                     else:
-                        ngram_groups = [ngram]
+                        freq, ngram = line.lstrip().split(" ", 1)
+                        freq = int(freq)
+
+                        if len(group_by) > 1:
+                            ngram_groups = ngram.split("\t")
+                        else:
+                            ngram_groups = [ngram]
 
                     all_ngrams = []
                     relative_to_pos = []
@@ -1807,22 +2665,22 @@ def count(args):
                     cross = list(itertools.product(*all_ngrams))
 
                     for ngram in cross:
-                        corpus_stats[query_no]["rows"][ngram]["absolute"] += int(freq)
-                        corpus_stats[query_no]["sums"]["absolute"] += int(freq)
-                        total_stats[query_no]["rows"][ngram]["absolute"] += int(freq)
-                        total_stats[query_no]["sums"]["absolute"] += int(freq)
+                        corpus_stats[query_no]["rows"][ngram]["absolute"] += freq
+                        corpus_stats[query_no]["sums"]["absolute"] += freq
+                        total_stats[query_no]["rows"][ngram]["absolute"] += freq
+                        total_stats[query_no]["sums"]["absolute"] += freq
 
                         if relative_to:
                             relativeto_ngram = tuple(ngram[pos] for pos in relative_to_pos)
-                            corpus_stats[query_no]["rows"][ngram]["relative"] += int(freq) / float(
+                            corpus_stats[query_no]["rows"][ngram]["relative"] += freq / float(
                                 relative_to_freqs["corpora"][corpus][relativeto_ngram]) * 1000000
-                            corpus_stats[query_no]["sums"]["relative"] += int(freq) / float(
+                            corpus_stats[query_no]["sums"]["relative"] += freq / float(
                                 relative_to_freqs["corpora"][corpus][relativeto_ngram]) * 1000000
-                            total_stats[query_no]["rows"][ngram]["relative"] += int(freq) / float(
+                            total_stats[query_no]["rows"][ngram]["relative"] += freq / float(
                                 relative_to_freqs["combined"][relativeto_ngram]) * 1000000
                         else:
-                            corpus_stats[query_no]["rows"][ngram]["relative"] += int(freq) / float(corpus_size) * 1000000
-                            corpus_stats[query_no]["sums"]["relative"] += int(freq) / float(corpus_size) * 1000000
+                            corpus_stats[query_no]["rows"][ngram]["relative"] += freq / float(corpus_size) * 1000000
+                            corpus_stats[query_no]["sums"]["relative"] += freq / float(corpus_size) * 1000000
 
                 result["corpora"][corpus] = corpus_stats
 
@@ -2053,7 +2911,8 @@ def count_time(args):
     corpora_sizes = {}
 
     ns = Namespace()
-    total_rows = [[] for _ in range(len(subcqp) + 1)]
+    # Hit frequencies per time bucket: (corpus, datefrom, dateto) -> frequency
+    total_buckets = [defaultdict(int) for _ in range(len(subcqp) + 1)]
     ns.total_size = 0
 
     ns.progress_count = 0
@@ -2104,20 +2963,23 @@ def count_time(args):
                     datefrom = datefrom.split(" ")[0]
                     dateto = dateto.split(" ")[0]
 
-                    total_rows[query_no].append({"corpus": corpus, "df": datefrom + timefrom, "dt": dateto + timeto,
-                                                 "sum": int(count)})
+                    # Bucket by granularity while aggregating, instead of keeping every distinct date pair
+                    bucket = timespan_bucket(datefrom + timefrom, dateto + timeto, granularity, strategy)
+                    if bucket is not None:
+                        total_buckets[query_no][(corpus,) + bucket] += int(count)
 
             if incremental:
                 yield {"progress_%d" % ns.progress_count: corpus}
                 ns.progress_count += 1
 
+    # The base data is the same as that of /timespan for the same corpora and range, so its cache is reused
     corpus_timedata = generator_to_dict(timespan({"corpus": corpora, "granularity": granularity, "from": fromdate,
                                                   "to": todate, "strategy": str(strategy), "cache": args["cache"]},
                                                  no_combined_cache=True))
     search_timedata = []
     search_timedata_combined = []
-    for total_row in total_rows:
-        temp = timespan_calculator(total_row, granularity=granularity, strategy=strategy)
+    for buckets in total_buckets:
+        temp = timespan_sum_buckets(buckets, granularity=granularity, combined=combined, per_corpus=per_corpus)
         if per_corpus:
             search_timedata.append(temp["corpora"])
         if combined:
@@ -2296,36 +3158,36 @@ def count_query_worker(corpus, cqp, group_by, within, ignore_case=[], cut=None,
 def count_query_worker_simple(corpus, cqp, group_by, within=None, ignore_case=[], expand_prequeries=True,
                               use_cache=False, request=request):
     """Worker for simple statistics queries which can be run using cwb-scan-corpus.
-    Currently only used for searches on [] (any word)."""
+    Currently only used for searches on [] (any word).
+
+    Unlike count_query_worker, the result rows are pairs (count, values), where values is a tuple with one value
+    per group_by attribute.
+    """
     # request is only for signature compatibity with count_query_worker
-    lines = list(run_cwb_scan(corpus, [g[0] for g in group_by]))
     nr_hits = 0
-
-    ic_index = []
-    new_lines = {}
-    if ignore_case:
-        ic_index = [i for i, g in enumerate(group_by) if g[0] in ignore_case]
-
-    for i in range(len(lines)):
-        c, v = lines[i].split("\t", 1)
-        nr_hits += int(c)
-
-        if ic_index:
-            v = "\t".join(vv.lower() if i in ic_index else vv for i, vv in enumerate(v.split("\t")))
-            new_lines[v] = new_lines.get(v, 0) + int(c)
-        else:
-            # Convert result to the same format as the regular CQP count
-            lines[i] = "%s %s" % (c, v)
+    nr_values = len(group_by)
+    ic_index = set(i for i, g in enumerate(group_by) if g[0] in ignore_case)
 
     if ic_index:
-        lines = []
-        for v, c in new_lines.items():
-            # Convert result to the same format as the regular CQP count
-            lines.append("%s %s" % (c, v))
+        # Fold case while reading, so that only the distinct folded values are kept in memory
+        counts = defaultdict(int)
+        for line in run_cwb_scan(corpus, [g[0] for g in group_by]):
+            c, *values = line.split("\t", nr_values)
+            c = int(c)
+            nr_hits += c
+            counts[tuple(v.lower() if i in ic_index else v for i, v in enumerate(values))] += c
+        rows = [(c, values) for values, c in counts.items()]
+    else:
+        rows = []
+        for line in run_cwb_scan(corpus, [g[0] for g in group_by]):
+            c, *values = line.split("\t", nr_values)
+            c = int(c)
+            nr_hits += c
+            rows.append((c, tuple(values)))
 
     # Corpus size equals number of hits since we count all tokens
     corpus_size = nr_hits
-    return lines, nr_hits, corpus_size
+    return rows, nr_hits, corpus_size
 
 
 @app.route("/loglike", methods=["GET", "POST"])
@@ -2337,59 +3199,64 @@ def loglike(args):
         """ The expected is that the words are uniformely distributed over the corpora. """
         return wordtotal * (float(total) / sumtotal)
 
-    def compute_loglike(wf1_tot1, wf2_tot2):
-        """ Compute log-likelihood for a single pair. """
-        wf1, tot1 = wf1_tot1
-        wf2, tot2 = wf2_tot2
-        e1 = expected(tot1, wf1 + wf2, tot1 + tot2)
-        e2 = expected(tot2, wf1 + wf2, tot1 + tot2)
-        (l1, l2) = (0, 0)
-        if wf1 > 0:
-            l1 = wf1 * math.log(wf1 / e1)
-        if wf2 > 0:
-            l2 = wf2 * math.log(wf2 / e2)
-        loglike = 2 * (l1 + l2)
-        return round(loglike, 2)
+    def align_freqs(d1, ref):
+        """ Align two frequency dicts by interned key. Return the list of keys and two frequency arrays. """
+        keys = list(d1)
+        index = dict(zip(keys, itertools.count()))
+        for w in ref:
+            if w not in index:
+                index[w] = len(keys)
+                keys.append(w)
+        f1 = numpy.zeros(len(keys))
+        f1[:len(d1)] = numpy.fromiter(d1.values(), dtype=float, count=len(d1))
+        f2 = numpy.zeros(len(keys))
+        f2[numpy.fromiter((index[w] for w in ref), dtype=numpy.intp, count=len(ref))] = numpy.fromiter(
+            ref.values(), dtype=float, count=len(ref))
+        return keys, f1, f2
 
     def compute_list(d1, tot1, ref, reftot):
-        """ Compute log-likelyhood for lists. """
-        result = []
-        all_w = set(d1.keys()).union(set(ref.keys()))
-        for w in all_w:
-            ll = compute_loglike((d1.get(w, 0), tot1), (ref.get(w, 0), reftot))
-            result.append((ll, w))
-        result.sort(reverse=True)
-        return result
-
-    def compute_ll_stats(ll_list, count, sets):
+        """ Compute log-likelihood for lists in one vectorized pass. Return keys, frequencies and values. """
+        keys, f1, f2 = align_freqs(d1, ref)
+        if not keys:
+            return keys, f1, f2, numpy.zeros(0)
+        e1 = expected(tot1, f1 + f2, tot1 + reftot)
+        e2 = expected(reftot, f1 + f2, tot1 + reftot)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            l1 = numpy.where(f1 > 0, f1 * numpy.log(f1 / e1), 0.0)
+            l2 = numpy.where(f2 > 0, f2 * numpy.log(f2 / e2), 0.0)
+        # Round with the built-in round(), as numpy.round() can round differently
+        ll = numpy.fromiter((round(x, 2) for x in (2 * (l1 + l2)).tolist()), dtype=float, count=len(keys))
+        return keys, f1, f2, ll
+
+    def top_indices(ll, keys, candidates, count):
+        """ Return the indices of the count highest values among candidates, ordered by (value, key). """
+        if count and len(candidates) > count:
+            # Partial sort to find the threshold; ties at the threshold are resolved by key below
+            values = ll[candidates]
+            threshold = numpy.partition(values, -count)[-count]
+            candidates = candidates[values >= threshold]
+        return sorted(candidates.tolist(), key=lambda i: (ll[i], keys[i]), reverse=True)[:count or None]
+
+    def compute_ll_stats(keys, f1, f2, ll, count, tot1, tot2):
         """ Calculate max, min, average, and truncates word list. """
-        tot = len(ll_list)
-        new_list = []
+        if not keys:
+            return [], 0.0, 0.0, 0.0
 
-        set1count, set2count = 0, 0
-        for ll_w in ll_list:
-            ll, w = ll_w
+        # Words relatively more frequent in the first set
+        in_set1 = (f1 > 0) & ((f2 == 0) | (f1 / float(tot1) > f2 / float(tot2)))
+        set1_top = top_indices(ll, keys, numpy.flatnonzero(in_set1), count)
+        set2_top = top_indices(ll, keys, numpy.flatnonzero(~in_set1), count)
+        set1_top_set = set(set1_top)
 
-            if (sets[0]["freq"].get(w) and not sets[1]["freq"].get(w)) or sets[0]["freq"].get(w) and (
-                sets[0]["freq"].get(w, 0) / (sets[0]["total"] * 1.0)) > (
-                sets[1]["freq"].get(w, 0) / (sets[1]["total"] * 1.0)):
-                set1count += 1
-                if set1count <= count or not count:
-                    new_list.append((ll * -1, w))
-            else:
-                set2count += 1
-                if set2count <= count or not count:
-                    new_list.append((ll, w))
-
-            if count and (set1count >= count and set2count >= count):
-                break
+        new_list = [(float(ll[i]) * (-1 if i in set1_top_set else 1), keys[i])
+                    for i in sorted(set1_top + set2_top, key=lambda i: (ll[i], keys[i]), reverse=True)]
 
-        nums = [ll for (ll, _) in ll_list]
         return (
             new_list,
-            round(sum(nums) / float(tot), 2) if tot else 0.0,
-            min(nums) if nums else 0.0,
-            max(nums) if nums else 0.0
+            # Summed in the same order as before vectorization, for identical rounding
+            round(sum(sorted(ll.tolist(), reverse=True)) / float(len(keys)), 2),
+            float(ll.min()),
+            float(ll.max())
         )
 
     assert_key("set1_cqp", args, r"", True)
@@ -2456,8 +3323,8 @@ def loglike(args):
                 (y[0], y[1] if isinstance(y[1], tuple) else (y[1],)) for y in sorted(x["value"].items())), x["absolute"])
                                    for x in count_result[i]["combined"]["rows"])
 
-    ll_list = compute_list(sets[0]["freq"], sets[0]["total"], sets[1]["freq"], sets[1]["total"])
-    (ws, avg, mi, ma) = compute_ll_stats(ll_list, maxresults, sets)
+    keys, f1, f2, ll = compute_list(sets[0]["freq"], sets[0]["total"], sets[1]["freq"], sets[1]["total"])
+    (ws, avg, mi, ma) = compute_ll_stats(keys, f1, f2, ll, maxresults, sets[0]["total"], sets[1]["total"])
 
     result["loglike"] = {}
     result["average"] = avg
@@ -2499,42 +3366,390 @@ def lemgram_count(args):
         count = count.split(QUERY_DELIM)
     count = set(count)
 
+    result = {}
+
+    # Use the in-process lemgram indexes if they have been loaded for all the corpora. The indexes of more corpora than
+    # fit in memory at once would only replace each other, so the database is then always used.
+    if corpora and len(set(corpora)) <= config.LEMGRAM_INDEX_SIZE:
+        indexes = dict((corpus, get_lemgram_index(corpus, args["cache"])) for corpus in set(corpora))
+        if None not in indexes.values():
+            columns = sorted(LemgramIndex.COLUMNS[c] for c in count)
+            for lg in lemgram:
+                freq = sum(index.count(lg, columns) for index in indexes.values())
+                if freq > 0:
+                    result[lg] = freq
+            yield result
+            return
+        load_lemgram_indexes([corpus for corpus, index in indexes.items() if index is None], args["cache"],
+                             request=request._get_current_object())
+
     counts = {"lemgram": "freq",
               "prefix": "freq_prefix",
               "suffix": "freq_suffix"}
 
-    sums = " + ".join("SUM(%s)" % counts[c] for c in count)
-
-    lemgram_sql = " lemgram IN (%s)" % ", ".join("'%s'" % sql_escape(l) for l in lemgram)
-    corpora_sql = " AND corpus IN (%s)" % ", ".join("'%s'" % sql_escape(c) for c in corpora) if corpora else ""
+    sums = " + ".join("SUM(%s)" % counts[c] for c in sorted(count))
 
-    sql = "SELECT lemgram, " + sums + " AS freq FROM lemgram_index WHERE" + lemgram_sql + corpora_sql + \
-          " GROUP BY lemgram COLLATE " + config.DBCOLLATE_LEMGRAM + ";"
+    sql = lemgram_count_sql(sums, len(lemgram), len(corpora))
+    params = list(lemgram) + list(corpora)
 
-    result = {}
-    with app.app_context():
-        cursor = mysql.connection.cursor()
-        sql_execute(cursor, sql)
+    with sql_pool.connection("lemgram_count") as conn:
+        cursor = conn.cursor()
+        sql_execute(cursor, sql, params)
 
-    for row in cursor:
-        # We need this check here, since a search for "hår" also returns "här" and "har".
-        if row["lemgram"] in lemgram and int(row["freq"]) > 0:
-            result[row["lemgram"]] = int(row["freq"])
+        for row in cursor:
+            # We need this check here, since a search for "hår" also returns "här" and "har".
+            if row["lemgram"] in lemgram and int(row["freq"]) > 0:
+                result[row["lemgram"]] = int(row["freq"])
 
-    cursor.close()
+        cursor.close()
 
     yield result
 
 
-def sql_escape(s):
-    with app.app_context():
-        return mysql.connection.escape_string(s).decode("utf-8") if isinstance(s, str) else s
+@functools.lru_cache(maxsize=1024)
+def lemgram_count_sql(sums, nr_lemgrams, nr_corpora):
+    """Return the SQL statement for /lemgram_count, with placeholders for the lemgrams and corpora."""
+    lemgram_sql = " lemgram IN (%s)" % sql_placeholders(nr_lemgrams)
+    corpora_sql = " AND corpus IN (%s)" % sql_placeholders(nr_corpora) if nr_corpora else ""
+    return "SELECT lemgram, " + sums + " AS freq FROM lemgram_index WHERE" + lemgram_sql + corpora_sql + \
+           " GROUP BY lemgram COLLATE " + config.DBCOLLATE_LEMGRAM + ";"
 
 
-def sql_execute(cursor, sql):
+class LemgramIndex:
+    """Lemgram, prefix and suffix frequencies of all the lemgrams in a corpus, from the lemgram_index table.
+
+    The lemgrams are kept in a sorted array of UTF-8 encoded strings, with their frequencies in the matching rows of
+    an array with a column for each kind of frequency.
+    """
+
+    # Column in the frequency array for each value of the count parameter of /lemgram_count
+    COLUMNS = {"lemgram": 0, "prefix": 1, "suffix": 2}
+
+    def __init__(self, version, rows):
+        self.version = version
+        # When the version was last found to be current
+        self.checked = time.time()
+        lemgrams = []
+        freqs = array.array("q")
+        for lemgram, freq, freq_prefix, freq_suffix in rows:
+            lemgrams.append(lemgram.encode("utf-8"))
+            freqs.extend((int(freq), int(freq_prefix), int(freq_suffix)))
+        lemgrams = numpy.array(lemgrams, dtype=bytes) if lemgrams else numpy.array([], dtype="S1")
+        order = numpy.argsort(lemgrams, kind="stable")
+        self.lemgrams = lemgrams[order]
+        self.freqs = numpy.frombuffer(freqs, dtype=numpy.int64).reshape(-1, 3)[order]
+
+    def count(self, lemgram, columns):
+        """Return the sum of the frequencies in columns for lemgram, or 0 if it is not in the corpus."""
+        key = lemgram.encode("utf-8")
+        if len(key) > self.lemgrams.itemsize:
+            return 0
+        i = numpy.searchsorted(self.lemgrams, key)
+        if i == len(self.lemgrams) or self.lemgrams[i] != key:
+            return 0
+        return int(self.freqs[i, columns].sum())
+
+
+# In-process lemgram indexes for /lemgram_count: corpus -> LemgramIndex
+lemgram_indexes = OrderedDict()
+# Corpora whose lemgram indexes are being loaded
+lemgram_indexes_loading = set()
+# Corpora whose lemgram indexes could not be loaded: corpus -> time of the failure
+lemgram_indexes_failed = {}
+lemgram_indexes_lock = native_lock()
+
+
+def get_lemgram_index(corpus, use_cache=False):
+    """Return the lemgram index of corpus if it has been loaded for the current corpus version.
+
+    The version is checked at most every LEMGRAM_INDEX_CHECK_INTERVAL seconds, and after /cache.
+    """
+    with lemgram_indexes_lock:
+        index = lemgram_indexes.get(corpus)
+        if index is not None:
+            lemgram_indexes.move_to_end(corpus)
+    if index is None:
+        return None
+    if time.time() - index.checked >= config.LEMGRAM_INDEX_CHECK_INTERVAL:
+        if index.version != get_corpus_version(corpus, use_cache):
+            return None
+        index.checked = time.time()
+    return index
+
+
+def invalidate_lemgram_indexes():
+    """Make the next use of each lemgram index check that it is for the current version of the corpus."""
+    with lemgram_indexes_lock:
+        for index in lemgram_indexes.values():
+            index.checked = 0
+        lemgram_indexes_failed.clear()
+
+
+def load_lemgram_indexes(corpora, use_cache=False, request=None):
+    """Start loading the lemgram indexes of corpora in the background, skipping the ones already being loaded.
+
+    The loading is done in a native thread, as a monkey patched thread would be a greenlet in the thread of the request,
+    not run until the request yields and then blocking it while loading.
+    """
+    with lemgram_indexes_lock:
+        # Corpora whose loading failed are retried only after a delay
+        retry_time = time.time() - LEMGRAM_INDEX_RETRY_DELAY
+        corpora = [corpus for corpus in corpora
+                   if corpus not in lemgram_indexes_loading and lemgram_indexes_failed.get(corpus, 0) < retry_time]
+        lemgram_indexes_loading.update(corpora)
+    if corpora:
+        native_thread = gevent.monkey.get_original("threading", "Thread")
+        native_thread(target=lemgram_index_worker, args=(corpora, use_cache, request), daemon=True).start()
+
+
+def lemgram_index_worker(corpora, use_cache=False, request=None):
+    """Load the lemgram indexes of corpora from the database."""
+    corpus = None
+    try:
+        with sql_pool.connection("lemgram_count") as conn:
+            for corpus in corpora:
+                # Get the version first, so that an update during loading causes the index to be reloaded
+                version = get_corpus_version(corpus, use_cache)
+                index = LemgramIndex(version, sql_stream(
+                    conn, "SELECT lemgram, SUM(freq), SUM(freq_prefix), SUM(freq_suffix) FROM lemgram_index "
+                          "WHERE corpus = %s GROUP BY lemgram COLLATE " + config.DBCOLLATE_LEMGRAM + ";",
+                    [corpus], request=request))
+                with lemgram_indexes_lock:
+                    lemgram_indexes[corpus] = index
+                    lemgram_indexes.move_to_end(corpus)
+                    while len(lemgram_indexes) > config.LEMGRAM_INDEX_SIZE:
+                        lemgram_indexes.popitem(last=False)
+    except Exception as e:
+        # The corpora not loaded are left to the database until the retry delay has passed
+        failed = corpora[corpora.index(corpus):] if corpus is not None else corpora
+        print("Could not load the lemgram indexes of %s: %s: %s" % (", ".join(failed), type(e).__name__, e))
+        with lemgram_indexes_lock:
+            lemgram_indexes_failed.update((corpus, time.time()) for corpus in failed)
+    finally:
+        with lemgram_indexes_lock:
+            lemgram_indexes_loading.difference_update(corpora)
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_placeholders(n):
+    """Return a comma separated list of n parameter placeholders."""
+    return ", ".join(["%s"] * n)
+
+
+def sql_execute(cursor, sql, params=None, request=None):
+    """Execute sql using cursor, binding the values in params to the %s placeholders in sql.
+
+    The filter_sql plugin hook gets the statement with the placeholders.
+    """
     sql = korppluginlib.KorpCallbackPluginCaller.filter_value_for_request(
-        "filter_sql", sql)
-    cursor.execute(sql)
+        "filter_sql", sql, request=request)
+    db_call(cursor.execute, sql, params)
+
+
+def sql_stream(conn, sql, params=None, request=None):
+    """Execute sql on an unbuffered cursor of conn and yield the result rows as tuples.
+
+    The rows are read from the server as they are consumed, DBFETCH_SIZE rows at a time, so the whole result is never
+    held in memory. No other statements can be executed on conn until the generator has been exhausted or closed.
+    """
+    cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        sql_execute(cursor, sql, params, request=request)
+        while True:
+            rows = db_call(cursor.fetchmany, config.DBFETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        # Discards any unread rows, reading them from the server
+        db_call(cursor.close)
+
+
+class SQLPoolTimeout(Exception):
+    pass
+
+
+class SQLConnectionPool:
+    """A bounded pool of database connections shared by all requests and threads.
+
+    At most size connections are open at the same time. A connection is checked for liveness when it is checked out,
+    and it is replaced if it is broken or older than max_lifetime seconds (0 = no limit).
+    """
+
+    def __init__(self, size, max_lifetime=0, **connect_args):
+        self.size = max(size, 1)
+        self.max_lifetime = max_lifetime
+        self.connect_args = connect_args
+        self._idle = []  # Pairs (connection, creation time)
+        self._in_use = 0
+        # Shared by the greenlets of the main thread and native threads, such as those of /relations
+        self._cond = gevent.monkey.get_original("threading", "Condition")()
+        self._wait_pool = None
+        self._stats = {"checkouts": 0, "timeouts": 0, "created": 0, "discarded": 0,
+                       "wait_time_total": 0.0, "wait_time_max": 0.0}
+
+    def _connect(self):
+        conn = db_call(functools.partial(MySQLdb.connect, **self.connect_args))
+        with self._cond:
+            self._stats["created"] += 1
+        return conn, time.time()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+        with self._cond:
+            self._stats["discarded"] += 1
+
+    def prewarm(self, n):
+        """Open connections until at least n (but at most size) connections are idle."""
+        while True:
+            with self._cond:
+                if len(self._idle) >= min(n, self.size - self._in_use):
+                    return
+            entry = self._connect()
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def close_idle(self):
+        """Close all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def checkout(self, timeout=None):
+        """Return a pair (connection, creation time), waiting at most timeout seconds for a free connection."""
+        starttime = time.time()
+        entry = self._take(starttime, timeout, wait=False)
+        if entry is False:
+            if gevent.get_hub().loop.default:
+                # Waiting on the native condition would block all the greenlets, so wait in a thread of our own
+                if not self._wait_pool:
+                    self._wait_pool = ThreadPool(config.WORKER_THREADS)
+                entry = self._wait_pool.apply(self._take, (starttime, timeout))
+            else:
+                entry = self._take(starttime, timeout)
+            if entry is False:
+                raise SQLPoolTimeout("Timed out waiting for a database connection.")
+
+        try:
+            if entry is not None:
+                conn, created = entry
+                if self.max_lifetime and time.time() - created > self.max_lifetime:
+                    self._discard(conn)
+                    entry = None
+                else:
+                    try:
+                        db_call(conn.ping)
+                    except MySQLdb.Error:
+                        self._discard(conn)
+                        entry = None
+            if entry is None:
+                entry = self._connect()
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return entry
+
+    def _take(self, starttime, timeout, wait=True):
+        """Take an idle connection or room for a new one, waiting until timeout seconds from starttime if wait is True.
+
+        Return the idle pair (connection, creation time), None if a new connection may be opened, or False if there
+        was no room in time or at once if wait is False.
+        """
+        with self._cond:
+            while not self._idle and self._in_use + len(self._idle) >= self.size:
+                if not wait:
+                    return False
+                remaining = None if timeout is None else timeout - (time.time() - starttime)
+                if remaining is not None and remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    return False
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            wait_time = time.time() - starttime
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+        return entry
+
+    def checkin(self, entry, discard=False):
+        """Return a connection checked out with checkout() to the pool, or close it if discard is True."""
+        if discard:
+            self._discard(entry[0])
+        with self._cond:
+            self._in_use -= 1
+            if not discard:
+                self._idle.append(entry)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, endpoint=None):
+        """Context manager checking out a connection for the duration of the block.
+
+        The time to wait for a free connection is configured per endpoint in DBPOOL_CHECKOUT_TIMEOUT.
+        """
+        timeouts = config.DBPOOL_CHECKOUT_TIMEOUT
+        entry = self.checkout(timeouts.get(endpoint, timeouts.get("default")))
+        try:
+            yield entry[0]
+        except MySQLdb.OperationalError:
+            # The connection may be broken
+            self.checkin(entry, discard=True)
+            raise
+        except:
+            self.checkin(entry)
+            raise
+        else:
+            self.checkin(entry)
+
+    def stats(self):
+        """Return pool occupancy and usage statistics."""
+        with self._cond:
+            stats = dict(self._stats, size=self.size, in_use=self._in_use, idle=len(self._idle))
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+
+# In-process catalogue of the word picture tables available in the database
+wp_tables_catalogue = {"tables": None, "updated": 0.0}
+wp_tables_lock = native_lock()
+
+
+def get_wp_tables(cursor):
+    """Return the set of names of word picture tables in the database.
+
+    The list of tables is kept in memory and only fetched again when it is older than DBWPTABLE_CATALOGUE_TTL
+    seconds, or after it has been invalidated by invalidate_wp_tables().
+    """
+    with wp_tables_lock:
+        tables = wp_tables_catalogue["tables"]
+        if tables is not None and time.time() - wp_tables_catalogue["updated"] < config.DBWPTABLE_CATALOGUE_TTL:
+            return tables
+
+    updated = time.time()
+    sql_execute(cursor, "SHOW TABLES LIKE '" + config.DBWPTABLE + "_%';")
+    tables = frozenset(list(x.values())[0] for x in cursor)
+
+    with wp_tables_lock:
+        # Don't overwrite a catalogue that has been invalidated or refreshed while we were querying
+        if updated >= wp_tables_catalogue["updated"]:
+            wp_tables_catalogue["tables"] = tables
+            wp_tables_catalogue["updated"] = updated
+    return tables
+
+
+def invalidate_wp_tables():
+    """Make the next call to get_wp_tables() fetch the list of tables from the database."""
+    with wp_tables_lock:
+        wp_tables_catalogue["tables"] = None
+        wp_tables_catalogue["updated"] = time.time()
 
 
 ################################################################################
@@ -2543,6 +3758,7 @@ def sql_execute(cursor, sql):
 
 @app.route("/timespan", methods=["GET", "POST"])
 @main_handler
+@use_etag(timespan_versions)
 @prevent_timeout
 def timespan(args, no_combined_cache=False):
     """Calculate timespan information for corpora.
@@ -2563,8 +3779,9 @@ def timespan(args, no_combined_cache=False):
     combined = parse_bool(args, "combined", True)
     per_corpus = parse_bool(args, "per_corpus", True)
     strategy = int(args.get("strategy") or 1)
-    fromdate = args.get("from")
-    todate = args.get("to")
+    # Treat empty values as missing, so that the same cache entries are used regardless of how /timespan is called
+    fromdate = args.get("from") or None
+    todate = args.get("to") or None
 
     if fromdate or todate:
         if not fromdate or not todate:
@@ -2582,6 +3799,7 @@ def timespan(args, no_combined_cache=False):
                                       per_corpus,
                                       fromdate,
                                       todate,
+                                      strategy,
                                       sorted(corpora)))
         cache_combined_key = "%s:timespan_%s" % (cache_prefix(), get_hash(combined_checksum))
         with mc_pool.reserve() as mc:
@@ -2596,7 +3814,7 @@ def timespan(args, no_combined_cache=False):
         # Look for per-corpus caches
         for corpus in corpora:
             corpus_checksum = get_hash((fromdate, todate, granularity, strategy))
-            cache_key = "%s:timespan_%s" % (cache_prefix(corpus), corpus_checksum)
+            cache_key = "%s:timespan_rows_%s" % (cache_prefix(corpus), corpus_checksum)
             with mc_pool.reserve() as mc:
                 corpus_cached_data = mc.get(cache_key)
 
@@ -2606,73 +3824,85 @@ def timespan(args, no_combined_cache=False):
 
     ns = {}
 
-    with app.app_context():
-        if corpora_rest:
-            corpora_sql = "(%s)" % ", ".join("'%s'" % sql_escape(c) for c in corpora_rest)
+    timedata_corpus = "timedata_date" if granularity in ("y", "m", "d") else "timedata"
+    # We need the full dates for strategy 1, so no truncating of the results
+    length = TIMESPAN_GRANULARITIES[granularity][1] if strategy != 1 else None
+
+    # Use the local timedata store for the corpora that have one, and the database for the rest
+    store_data = []
+    sql_corpora = []
+    for corpus in corpora_rest:
+        corpus_rows = timedata_store_rows(corpus, timedata_corpus, length, strategy, fromdate, todate)
+        if corpus_rows is None:
+            sql_corpora.append(corpus)
+        else:
+            store_data.extend(corpus_rows)
+
+    with (sql_pool.connection("timespan") if sql_corpora else contextlib.nullcontext()) as conn:
+        if sql_corpora:
             fromto = ""
+            fromto_params = []
 
             if strategy == 1:
                 if fromdate and todate:
-                    fromto = " AND ((datefrom >= %s AND dateto <= %s) OR (datefrom <= %s AND dateto >= %s))" % (
-                        sql_escape(fromdate), sql_escape(todate), sql_escape(fromdate), sql_escape(todate))
+                    fromto = " AND ((datefrom >= %s AND dateto <= %s) OR (datefrom <= %s AND dateto >= %s))"
+                    fromto_params = [fromdate, todate, fromdate, todate]
             elif strategy == 2:
                 if todate:
-                    fromto += " AND datefrom <= '%s'" % sql_escape(todate)
+                    fromto += " AND datefrom <= %s"
+                    fromto_params.append(todate)
                 if fromdate:
-                    fromto = " AND dateto >= '%s'" % sql_escape(fromdate)
+                    fromto = " AND dateto >= %s"
+                    fromto_params = [fromdate]
             elif strategy == 3:
                 if fromdate:
-                    fromto = " AND datefrom >= '%s'" % sql_escape(fromdate)
+                    fromto = " AND datefrom >= %s"
+                    fromto_params = [fromdate]
                 if todate:
-                    fromto += " AND dateto <= '%s'" % sql_escape(todate)
+                    fromto += " AND dateto <= %s"
+                    fromto_params.append(todate)
 
             # TODO: Skip grouping on corpus when we only are after the combined results.
             # We do the granularity truncation and summation in the DB query if we can (depending on strategy),
             # since it's much faster than doing it afterwards
-
-            timedata_corpus = "timedata_date" if granularity in ("y", "m", "d") else "timedata"
-            if strategy == 1:
-                # We need the full dates for this strategy, so no truncating of the results
-                sql = "SELECT corpus, datefrom AS df, dateto AS dt, SUM(tokens) AS sum FROM " + timedata_corpus + \
-                      " WHERE corpus IN " + corpora_sql + fromto + " GROUP BY corpus, df, dt ORDER BY NULL;"
-            else:
-                sql = "SELECT corpus, LEFT(datefrom, " + str(shorten[granularity]) + ") AS df, LEFT(dateto, " + \
-                      str(shorten[granularity]) + ") AS dt, SUM(tokens) AS sum FROM " + timedata_corpus + \
-                      " WHERE corpus IN " + corpora_sql + fromto + " GROUP BY corpus, df, dt ORDER BY NULL;"
-            cursor = mysql.connection.cursor()
-            sql_execute(cursor, sql)
+            sql = timespan_sql(timedata_corpus, shorten[granularity] if strategy != 1 else None, len(sql_corpora),
+                               fromto)
+            sql_rows = sql_stream(conn, sql, sql_corpora + fromto_params)
         else:
-            cursor = tuple()
+            sql_rows = ()
+        rows = itertools.chain(store_data, sql_rows)
 
-        if args["cache"]:
-            def save_cache(corpus, data):
-                corpus_checksum = get_hash((fromdate, todate, granularity, strategy))
-                cache_key = "%s:timespan_%s" % (cache_prefix(corpus), corpus_checksum)
-                with mc_pool.reserve() as mc:
-                    try:
-                        mc.add(cache_key, data)
-                    except pylibmc.TooBig:
-                        pass
+        try:
+            if args["cache"]:
+                def save_cache(corpus, data):
+                    corpus_checksum = get_hash((fromdate, todate, granularity, strategy))
+                    cache_key = "%s:timespan_rows_%s" % (cache_prefix(corpus), corpus_checksum)
+                    with mc_pool.reserve() as mc:
+                        try:
+                            mc.add(cache_key, data)
+                        except pylibmc.TooBig:
+                            pass
 
-            corpus = None
-            corpus_data = []
-            for row in cursor:
-                if corpus is None:
-                    corpus = row["corpus"]
-                elif not row["corpus"] == corpus:
+                corpus = None
+                corpus_data = []
+                for row in rows:
+                    if corpus is None:
+                        corpus = row[0]
+                    elif not row[0] == corpus:
+                        save_cache(corpus, corpus_data)
+                        corpus_data = []
+                        corpus = row[0]
+                    corpus_data.append(row)
+                    cached_data.append(row)
+                if corpus is not None:
                     save_cache(corpus, corpus_data)
-                    corpus_data = []
-                    corpus = row["corpus"]
-                corpus_data.append(row)
-                cached_data.append(row)
-            if corpus is not None:
-                save_cache(corpus, corpus_data)
 
-        ns["result"] = timespan_calculator(itertools.chain(cached_data, cursor), granularity=granularity,
-                                           combined=combined, per_corpus=per_corpus, strategy=strategy)
-
-        if corpora_rest:
-            cursor.close()
+            ns["result"] = timespan_calculator(itertools.chain(cached_data, rows), granularity=granularity,
+                                               combined=combined, per_corpus=per_corpus, strategy=strategy)
+        finally:
+            # Make sure that the connection has no unread rows when it is returned to the pool
+            if sql_corpora:
+                sql_rows.close()
 
     if args["cache"] and not no_combined_cache:
         # Save cache for whole query
@@ -2685,11 +3915,25 @@ def timespan(args, no_combined_cache=False):
     yield ns["result"]
 
 
+@functools.lru_cache(maxsize=1024)
+def timespan_sql(table, length, nr_corpora, fromto):
+    """Return the SQL statement for /timespan, with placeholders for the corpora and the dates in fromto.
+
+    If length is set, the dates are truncated to that many characters.
+    """
+    if length is None:
+        dates = "datefrom AS df, dateto AS dt"
+    else:
+        dates = "LEFT(datefrom, %d) AS df, LEFT(dateto, %d) AS dt" % (length, length)
+    return "SELECT corpus, " + dates + ", SUM(tokens) AS sum FROM " + table + " WHERE corpus IN (" + \
+           sql_placeholders(nr_corpora) + ")" + fromto + " GROUP BY corpus, df, dt ORDER BY NULL;"
+
+
 def timespan_calculator(timedata, granularity="y", combined=True, per_corpus=True, strategy=1):
     """Calculate timespan information for corpora.
 
     The required parameters are
-     - timedata: the time data to be processed
+     - timedata: the time data to be processed, as rows of corpus, datefrom, dateto and number of tokens
 
     The optional parameters are
      - granularity: granularity of result (y = year, m = month, d = day, h = hour, n = minute, s = second)
@@ -2699,110 +3943,122 @@ def timespan_calculator(timedata, granularity="y", combined=True, per_corpus=Tru
      - per_corpus: include results per corpus
        (default: true)
     """
+    buckets = defaultdict(int)
+    for corpus, datefrom, dateto, tokens in timedata:
+        bucket = timespan_bucket(datefrom, dateto, granularity, strategy)
+        if bucket is not None:
+            buckets[(corpus,) + bucket] += int(tokens)
+
+    return timespan_sum_buckets(buckets, granularity=granularity, combined=combined, per_corpus=per_corpus)
+
+
+# Date format, date length and step of each timespan granularity
+TIMESPAN_GRANULARITIES = {
+    "y": ("%Y", 4, relativedelta(years=1)),
+    "m": ("%Y%m", 6, relativedelta(months=1)),
+    "d": ("%Y%m%d", 8, relativedelta(days=1)),
+    "h": ("%Y%m%d%H", 10, relativedelta(hours=1)),
+    "n": ("%Y%m%d%H%M", 12, relativedelta(minutes=1)),
+    "s": ("%Y%m%d%H%M%S", 14, relativedelta(seconds=1)),
+}
+
+
+def timespan_step(date, granularity, negative=False):
+    """Add (or subtract) one unit of granularity to a shortened date given as a string."""
+    df, _, add = TIMESPAN_GRANULARITIES[granularity]
+    date = "0" + date if len(date) % 2 else date  # Handle years with three digits
+    d = strptime(date)
+    if negative:
+        d = d - add
+    else:
+        d = d + add
+    return int(d.strftime(df))
 
-    gs = {"y": 4, "m": 6, "d": 8, "h": 10, "n": 12, "s": 14}
 
-    def plusminusone(date, value, df, negative=False):
-        date = "0" + date if len(date) % 2 else date  # Handle years with three digits
-        d = strptime(date)
-        if negative:
-            d = d - value
-        else:
-            d = d + value
-        return int(d.strftime(df))
+@functools.lru_cache(maxsize=65536)
+def timespan_bucket(datefrom, dateto, granularity="y", strategy=1):
+    """Return the time bucket (shortened datefrom and dateto) that a span of time counts towards with the given
+    granularity and strategy, or None if the span is not counted.
+    """
+    g = TIMESPAN_GRANULARITIES[granularity][1]
 
-    def shorten(date, g):
+    def shorten(date):
         alt = 1 if len(date) % 2 else 0  # Handle years with three digits
-        return int(date[:gs[g] - alt])
-
-    if granularity == "y":
-        df = "%Y"
-        add = relativedelta(years=1)
-    elif granularity == "m":
-        df = "%Y%m"
-        add = relativedelta(months=1)
-    elif granularity == "d":
-        df = "%Y%m%d"
-        add = relativedelta(days=1)
-    elif granularity == "h":
-        df = "%Y%m%d%H"
-        add = relativedelta(hours=1)
-    elif granularity == "n":
-        df = "%Y%m%d%H%M"
-        add = relativedelta(minutes=1)
-    elif granularity == "s":
-        df = "%Y%m%d%H%M%S"
-        add = relativedelta(seconds=1)
-
-    rows = defaultdict(list)
-    nodes = defaultdict(set)
+        return int(date[:g - alt])
 
     datemin = "00000101" if granularity in ("y", "m", "d") else "00000101000000"
     datemax = "99991231" if granularity in ("y", "m", "d") else "99991231235959"
 
-    for row in timedata:
-        corpus = row["corpus"]
-        datefrom = "".join(x for x in str(row["df"]) if x.isdigit()) if row["df"] else ""
-        if datefrom == "0" * len(datefrom):
-            datefrom = ""
-        dateto = "".join(x for x in str(row["dt"]) if x.isdigit()) if row["dt"] else ""
-        if dateto == "0" * len(dateto):
-            dateto = ""
-        datefrom_short = shorten(datefrom, granularity) if datefrom else 0
-        dateto_short = shorten(dateto, granularity) if dateto else 0
+    datefrom = "".join(x for x in str(datefrom) if x.isdigit()) if datefrom else ""
+    if datefrom == "0" * len(datefrom):
+        datefrom = ""
+    dateto = "".join(x for x in str(dateto) if x.isdigit()) if dateto else ""
+    if dateto == "0" * len(dateto):
+        dateto = ""
+    datefrom_short = shorten(datefrom) if datefrom else 0
+    dateto_short = shorten(dateto) if dateto else 0
+
+    if strategy == 1:
+        # Some overlaps permitted
+        # (t1 >= t1' AND t2 <= t2') OR (t1 <= t1' AND t2 >= t2')
+        if not datefrom_short == dateto_short:
+            if not datefrom[g:] == datemin[g:]:
+                # Add 1 to datefrom_short
+                datefrom_short = timespan_step(str(datefrom_short), granularity)
+
+            if not dateto[g:] == datemax[g:]:
+                # Subtract 1 from dateto_short
+                dateto_short = timespan_step(str(dateto_short), granularity, negative=True)
+
+            # Check that datefrom is still before dateto
+            if not datefrom < dateto:
+                return None
+    elif strategy == 2:
+        # All overlaps permitted
+        # t1 <= t2' AND t2 >= t1'
+        pass
+    elif strategy == 3:
+        # Strict matching. No overlaps tolerated.
+        # t1 >= t1' AND t2 <= t2'
+
+        if not datefrom_short == dateto_short:
+            return None
 
-        if strategy == 1:
-            # Some overlaps permitted
-            # (t1 >= t1' AND t2 <= t2') OR (t1 <= t1' AND t2 >= t2')
-            if not datefrom_short == dateto_short:
-                if not datefrom[gs[granularity]:] == datemin[gs[granularity]:]:
-                    # Add 1 to datefrom_short
-                    datefrom_short = plusminusone(str(datefrom_short), add, df)
-
-                if not dateto[gs[granularity]:] == datemax[gs[granularity]:]:
-                    # Subtract 1 from dateto_short
-                    dateto_short = plusminusone(str(dateto_short), add, df, negative=True)
-
-                # Check that datefrom is still before dateto
-                if not datefrom < dateto:
-                    continue
-        elif strategy == 2:
-            # All overlaps permitted
-            # t1 <= t2' AND t2 >= t1'
-            pass
-        elif strategy == 3:
-            # Strict matching. No overlaps tolerated.
-            # t1 >= t1' AND t2 <= t2'
+    return datefrom_short, dateto_short
 
-            if not datefrom_short == dateto_short:
-                continue
 
-        r = {"datefrom": datefrom_short, "dateto": dateto_short, "corpus": corpus, "freq": int(row["sum"])}
+def timespan_sum_buckets(buckets, granularity="y", combined=True, per_corpus=True):
+    """Calculate timespan information from time buckets.
+
+    buckets is a dict with (corpus, datefrom, dateto) as keys and frequencies as values, where datefrom and dateto
+    are as returned by timespan_bucket(). The result is the same as that of timespan_calculator().
+    """
+    rows = defaultdict(lambda: defaultdict(int))
+    for (corpus, datefrom, dateto), freq in buckets.items():
         if combined:
-            rows["__combined__"].append(r)
-            nodes["__combined__"].add(("f", datefrom_short))
-            nodes["__combined__"].add(("t", dateto_short))
+            rows["__combined__"][(datefrom, dateto)] += freq
         if per_corpus:
-            rows[corpus].append(r)
-            nodes[corpus].add(("f", datefrom_short))
-            nodes[corpus].add(("t", dateto_short))
+            rows[corpus][(datefrom, dateto)] += freq
 
-    corpusnodes = dict((k, sorted(v, key=lambda x: (x[1] if x[1] else 0, x[0])))
-                       for k, v in nodes.items())
     result = {}
     if per_corpus:
         result["corpora"] = {}
     if combined:
         result["combined"] = {}
 
-    for corpus, nodes in corpusnodes.items():
+    for corpus, corpus_rows in rows.items():
+        nodes = set()
+        for datefrom, dateto in corpus_rows:
+            nodes.add(("f", datefrom))
+            nodes.add(("t", dateto))
+        nodes = sorted(nodes, key=lambda x: (x[1] if x[1] else 0, x[0]))
         data = defaultdict(int)
 
         for i in range(0, len(nodes) - 1):
             start = nodes[i]
             end = nodes[i + 1]
             if start[0] == "t":
-                start = plusminusone(str(start[1]), add, df) if start[1] else 0
+                start = timespan_step(str(start[1]), granularity) if start[1] else 0
                 if start == end[1] and end[0] == "f":
                     continue
             else:
@@ -2811,17 +4067,17 @@ def timespan_calculator(timedata, granularity="y", combined=True, per_corpus=Tru
             if not end[1]:
                 end = 0
             else:
-                end = end[1] if end[0] == "t" else plusminusone(str(end[1]), add, df, True)
+                end = end[1] if end[0] == "t" else timespan_step(str(end[1]), granularity, True)
 
             if start:
                 data["%d" % start] = 0
 
-            for row in rows[corpus]:
-                if row["datefrom"] <= start and row["dateto"] >= end:
-                    data[str(start if start else "")] += row["freq"]
+            for (datefrom, dateto), freq in corpus_rows.items():
+                if datefrom <= start and dateto >= end:
+                    data[str(start if start else "")] += freq
 
             if end:
-                data["%d" % plusminusone(str(end), add, df, False)] = 0
+                data["%d" % timespan_step(str(end), granularity)] = 0
 
         if combined and corpus == "__combined__":
             result["combined"] = data
@@ -2831,6 +4087,141 @@ def timespan_calculator(timedata, granularity="y", combined=True, per_corpus=Tru
     return result
 
 
+################################################################################
+# TIMEDATA STORE
+################################################################################
+
+# Memory-mapped timedata arrays: (corpus, table) -> (file modification time, array)
+timedata_arrays = {}
+timedata_arrays_lock = threading.Lock()
+
+# Dates are stored as integers of the digits of the date (YYYYMMDD for timedata_date, YYYYMMDDhhmmss for timedata),
+# with 0 for missing dates
+TIMEDATA_DTYPE = numpy.dtype([("datefrom", "<i8"), ("dateto", "<i8"), ("tokens", "<i8")])
+
+
+def timedata_store_path(corpus, table):
+    return os.path.join(config.TIMEDATA_DIR, "%s.%s.npy" % (corpus.upper(), table))
+
+
+def timedata_int(date):
+    """Convert a date (as a string or a date object) to an integer of its digits, or 0 if it is missing."""
+    date = "".join(x for x in str(date) if x.isdigit()) if date else ""
+    return int(date) if date else 0
+
+
+def get_timedata_array(corpus, table):
+    """Return the stored timedata table of corpus as a memory-mapped array, or None if it isn't stored."""
+    if not config.TIMEDATA_DIR:
+        return None
+    path = timedata_store_path(corpus, table)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with timedata_arrays_lock:
+        entry = timedata_arrays.get((corpus, table))
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+    data = numpy.load(path, mmap_mode="r")
+    with timedata_arrays_lock:
+        timedata_arrays[(corpus, table)] = (mtime, data)
+    return data
+
+
+def timedata_group(datefrom, dateto, tokens):
+    """Sum tokens for each distinct pair of datefrom and dateto. Return the sorted pairs and their sums as arrays."""
+    if not len(tokens):
+        return datefrom, dateto, tokens
+    order = numpy.lexsort((dateto, datefrom))
+    datefrom, dateto, tokens = datefrom[order], dateto[order], tokens[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], (datefrom[1:] != datefrom[:-1]) |
+                                                  (dateto[1:] != dateto[:-1]))))
+    return datefrom[starts], dateto[starts], numpy.add.reduceat(tokens, starts)
+
+
+def timedata_store_rows(corpus, table, length, strategy, fromdate=None, todate=None):
+    """Return the timespan rows of corpus from the timedata store, or None if the corpus has no stored timedata.
+
+    The rows are the same as the ones selected from the timedata tables by /timespan. If length is set, the dates are
+    truncated to that many digits.
+    """
+    data = get_timedata_array(corpus, table)
+    if data is None:
+        return None
+    digits = 8 if table == "timedata_date" else 14
+    datefrom = data["datefrom"]
+    dateto = data["dateto"]
+    tokens = data["tokens"]
+
+    if fromdate or todate:
+        # Compare the dates the way the database compares dates with the date strings
+        scale = 10 ** (14 - digits)
+        fromdate = timedata_int(fromdate)
+        todate = timedata_int(todate)
+        fromdate = fromdate * 10 ** (14 - len(str(fromdate))) if fromdate else 0
+        todate = todate * 10 ** (14 - len(str(todate))) if todate else 0
+        if strategy == 1:
+            mask = (((datefrom * scale >= fromdate) & (dateto * scale <= todate)) |
+                    ((datefrom * scale <= fromdate) & (dateto * scale >= todate)))
+        elif strategy == 2:
+            mask = dateto * scale >= fromdate
+        else:
+            mask = (datefrom * scale >= fromdate) & (dateto * scale <= todate)
+        datefrom, dateto, tokens = datefrom[mask], dateto[mask], tokens[mask]
+
+    if length:
+        datefrom = datefrom // 10 ** (digits - length)
+        dateto = dateto // 10 ** (digits - length)
+        digits = length
+    datefrom, dateto, tokens = timedata_group(numpy.asarray(datefrom), numpy.asarray(dateto), numpy.asarray(tokens))
+
+    corpus = corpus.upper()
+    return [(corpus, "%0*d" % (digits, df), "%0*d" % (digits, dt), s)
+            for df, dt, s in zip(datefrom.tolist(), dateto.tolist(), tokens.tolist())]
+
+
+def build_timedata_store(corpus, from_cwb=False):
+    """Create or replace the stored timedata of corpus, read from the timedata tables or from the corpus itself."""
+    tables = {}
+    if from_cwb:
+        timedata = []
+        timedata_date = []
+        for line in run_cwb_scan(corpus.lower(), ["text_datefrom", "text_timefrom", "text_dateto", "text_timeto"]):
+            count, datefrom, timefrom, dateto, timeto = line.split("\t")
+            # Only use the value from the first token
+            datefrom = timedata_int(datefrom.split(" ")[0])
+            dateto = timedata_int(dateto.split(" ")[0])
+            timefrom = timedata_int(timefrom.split(" ")[0])
+            timeto = timedata_int(timeto.split(" ")[0]) if timeto.strip() else 235959
+            timedata.append((datefrom * 1000000 + timefrom if datefrom else 0,
+                             dateto * 1000000 + timeto if dateto else 0, int(count)))
+            timedata_date.append((datefrom, dateto, int(count)))
+        tables["timedata"] = timedata
+        tables["timedata_date"] = timedata_date
+    else:
+        with sql_pool.connection() as conn:
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            for table in ("timedata", "timedata_date"):
+                cursor.execute("SELECT datefrom, dateto, SUM(tokens) FROM " + table +
+                               " WHERE corpus = %s GROUP BY datefrom, dateto;", (corpus.upper(),))
+                tables[table] = [(timedata_int(datefrom), timedata_int(dateto), int(tokens))
+                                 for datefrom, dateto, tokens in cursor]
+            cursor.close()
+
+    os.makedirs(config.TIMEDATA_DIR, exist_ok=True)
+    for table, rows in tables.items():
+        data = numpy.array(rows, dtype=TIMEDATA_DTYPE)
+        datefrom, dateto, tokens = timedata_group(data["datefrom"], data["dateto"], data["tokens"])
+        data = numpy.empty(len(tokens), dtype=TIMEDATA_DTYPE)
+        data["datefrom"], data["dateto"], data["tokens"] = datefrom, dateto, tokens
+        # Write to a temporary file first, so that requests never see a partly written file
+        path = timedata_store_path(corpus, table)
+        temp_path = path[:-len(".npy")] + ".tmp.npy"
+        numpy.save(temp_path, data)
+        os.replace(temp_path, path)
+
+
 ################################################################################
 # RELATIONS
 ################################################################################
@@ -2845,6 +4236,7 @@ def relations(args):
     assert_key("type", args, r"(word|lemgram)", False)
     assert_key("min", args, IS_NUMBER, False)
     assert_key("max", args, IS_NUMBER, False)
+    assert_key("sort", args, r"(mi|freq)", False)
     assert_key("incremental", args, r"(true|false)")
 
     corpora = parse_corpora(args)
@@ -2857,17 +4249,15 @@ def relations(args):
     minfreq = args.get("min")
     sort = args.get("sort") or "mi"
     maxresults = int(args.get("max") or 15)
-    minfreqsql = " AND freq >= %s" % minfreq if minfreq else ""
 
     result = {}
 
-    with app.app_context():
-        cursor = mysql.connection.cursor()
+    with sql_pool.connection("relations") as conn:
+        cursor = conn.cursor()
         sql_execute(cursor, "SET @@session.long_query_time = 1000;")
 
         # Get available tables
-        sql_execute(cursor, "SHOW TABLES LIKE '" + config.DBWPTABLE + "_%';")
-        tables = set(list(x.values())[0] for x in cursor)
+        tables = get_wp_tables(cursor)
         # Filter out corpora which don't exist in database
         corpora = [x for x in corpora if config.DBWPTABLE + "_" + x.upper() in tables]
         if not corpora:
@@ -2877,162 +4267,282 @@ def relations(args):
         relations_data = []
         corpora_rest = corpora[:]
 
+        # For a single corpus without a cut-off frequency, only the top rows need to be read from a materialized
+        # table, since the MI values and rankings in it are then the same as the ones calculated here
+        top = maxresults if len(corpora) == 1 and sort == "mi" and not minfreq else 0
+        corpus_checksum = get_hash((word, search_type, minfreq) + ((top,) if top else ()))
+
         if args["cache"]:
             for corpus in corpora:
-                corpus_checksum = get_hash((word,
-                                            search_type,
-                                            minfreq))
                 with mc_pool.reserve() as mc:
-                    cached_data = mc.get("%s:relations_%s" % (cache_prefix(corpus), corpus_checksum))
+                    cached_data = mc.get("%s:relations_rows_%s" % (cache_prefix(corpus), corpus_checksum))
                 if cached_data is not None:
                     relations_data.extend(cached_data)
                     corpora_rest.remove(corpus)
 
-        selects = []
+        selects = {}
+        form = "bf" if search_type == "lemgram" else "wf"
 
-        if search_type == "lemgram":
-            lemgram_sql = "'%s'" % sql_escape(word)
-
-            for corpus in corpora_rest:
-                corpus_sql = "'%s'" % sql_escape(corpus).upper()
-                corpus_table = config.DBWPTABLE + "_" + corpus.upper()
-
-                selects.append((corpus.upper(),
-                                "(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + corpus_sql + " AS corpus, F.id " +
-                                "FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                                "WHERE S1.string = " + lemgram_sql + " COLLATE " + config.DBCOLLATE_LEMGRAM + " AND F.head = S1.id AND S2.id = F.dep " +
-                                minfreqsql +
-                                "AND F.bfhead = 1 AND F.bfdep = 1 AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                                ))
-                selects.append((None,
-                                "(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + corpus_sql + " AS corpus, F.id " +
-                                "FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                                "WHERE S2.string = " + lemgram_sql + " COLLATE " + config.DBCOLLATE_LEMGRAM + " AND F.dep = S2.id AND S1.id = F.head " +
-                                minfreqsql +
-                                "AND F.bfhead = 1 AND F.bfdep = 1 AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                                ))
-        else:
-            word_sql = "'%s'" % sql_escape(word)
-            word = word
-
-            for corpus in corpora_rest:
-                corpus_sql = "'%s'" % sql_escape(corpus).upper()
-                corpus_table = config.DBWPTABLE + "_" + corpus.upper()
-
-                selects.append((corpus.upper(),
-                                "(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + corpus_sql + " AS corpus, F.id " +
-                                "FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                                "WHERE S1.string = " + word_sql + " AND F.head = S1.id AND F.wfhead = 1 AND S2.id = F.dep " +
-                                minfreqsql +
-                                "AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                                ))
-                selects.append((None,
-                                "(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + corpus_sql + " AS corpus, F.id " +
-                                "FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                                "WHERE S2.string = " + word_sql + " AND F.dep = S2.id AND F.wfdep = 1 AND S1.id = F.head " +
-                                minfreqsql +
-                                "AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                                ))
-
-        cursor_result = []
-        if corpora_rest:
-            if incremental:
-                yield {"progress_corpora": list(corpora_rest)}
-                progress_count = 0
-                for sql in selects:
-                    sql_execute(cursor, sql[1])
-                    cursor_result.extend(list(cursor))
-                    if sql[0]:
-                        yield {"progress_%d" % progress_count: {"corpus": sql[0]}}
-                        progress_count += 1
+        for corpus in corpora_rest:
+            corpus_table = config.DBWPTABLE + "_" + corpus.upper()
+            params = [corpus.upper(), word] + ([int(minfreq)] if minfreq else [])
+
+            if corpus_table + "_mi" in tables:
+                sqls = relations_mi_sql(corpus_table + "_mi", form, bool(minfreq), top)
             else:
-                sql = " UNION ALL ".join(x[1] for x in selects)
-                sql_execute(cursor, sql)
-                cursor_result = cursor
+                sqls = relations_sql(corpus_table, form, bool(minfreq))
+            selects[corpus] = [(sql, params) for sql in sqls]
 
-    rels = {}
-    counter = {}
-    freq_rel = {}
-    freq_head_rel = {}
-    freq_rel_dep = {}
+        cursor.close()
 
-    do_caching = False
-    corpus = None
-    corpus_data = []
+    # Every distinct (head, rel, dep) triple gets an index into the lists below
+    rel_index = {}
+    rel_keys = []
+    rel_freqs = []
+    # Source ids of each triple, as corpus index and row id packed into one integer
+    rel_sources = []
+    # Corpus indexes follow the order of the corpora, not the order in which their queries complete
+    corpus_index = dict((corpus.upper(), c) for c, corpus in enumerate(corpora))
+    # Frequencies of relations, head-relation and relation-dependent pairs per corpus index
+    freq_rel = defaultdict(dict)
+    freq_head_rel = defaultdict(dict)
+    freq_rel_dep = defaultdict(dict)
+    # The rows are added by the query threads as they are read. The threads are native ones, so a native lock is needed
+    # even if threading has been monkey patched.
+    rows_lock = native_lock()
+
+    def add_rows(rows):
+        with rows_lock:
+            for (head, headpos, rel, dep, deppos, depextra, freq, rel_freq, head_rel_freq, dep_rel_freq, corpus,
+                 source_id) in rows:
+                head = (head, headpos)
+                dep = (dep, deppos, depextra)
+                key = (head, rel, dep)
+                i = rel_index.get(key)
+                if i is None:
+                    i = rel_index[key] = len(rel_keys)
+                    rel_keys.append(key)
+                    rel_freqs.append(0)
+                    rel_sources.append(array.array("q"))
+                c = corpus_index.setdefault(corpus, len(corpus_index))
+                rel_freqs[i] += freq
+                rel_sources[i].append((c << RELATIONS_SOURCE_ID_BITS) | source_id)
+                freq_rel[rel][c] = rel_freq
+                freq_head_rel[(head, rel)][c] = head_rel_freq
+                freq_rel_dep[(rel, dep)][c] = dep_rel_freq
+
+    add_rows(relations_data)
+    del relations_data
+
+    if corpora_rest:
+        if incremental:
+            yield {"progress_corpora": list(corpora_rest)}
+            progress_count = 0
+
+        # Run the queries for each corpus in parallel in native threads, each on its own connection, and handle the
+        # results of each corpus as soon as they are ready. Monkey patched threads would be greenlets in this thread,
+        # running the blocking database calls one at a time.
+        with gevent.threadpool.ThreadPoolExecutor(max_workers=config.DBWP_PARALLEL_QUERIES) as executor:
+            future_query = dict((executor.submit(relations_corpus_worker, selects[corpus], add_rows,
+                                                 keep_rows=args["cache"], request=request._get_current_object()),
+                                 corpus)
+                                for corpus in corpora_rest)
 
-    def save_cache(corpus, data):
-        corpus_checksum = get_hash((word, search_type, minfreq))
-        with mc_pool.reserve() as mc:
-            try:
-                mc.add("%s:relations_%s" % (cache_prefix(corpus), corpus_checksum), data)
-            except pylibmc.TooBig:
-                pass
+            for future in futures.as_completed(future_query):
+                corpus = future_query[future]
+                rows = future.result()
 
-    for row in itertools.chain(relations_data, (None,), cursor_result):
-        if row is None:
-            do_caching = args["cache"]
-            continue
+                if args["cache"]:
+                    with mc_pool.reserve() as mc:
+                        try:
+                            mc.add("%s:relations_rows_%s" % (cache_prefix(corpus), corpus_checksum), rows)
+                        except pylibmc.TooBig:
+                            pass
 
-        if do_caching:
-            if corpus is None:
-                corpus = row["corpus"]
-            elif not row["corpus"] == corpus:
-                save_cache(corpus, corpus_data)
-                corpus_data = []
-                corpus = row["corpus"]
-            corpus_data.append(row)
-
-        head = (row["head"], row["headpos"])
-        dep = (row["dep"], row["deppos"], row["depextra"])
-        rels.setdefault((head, row["rel"], dep), {"freq": 0, "source": set()})
-        rels[(head, row["rel"], dep)]["freq"] += row["freq"]
-        rels[(head, row["rel"], dep)]["source"].add("%s:%d" % (row["corpus"], row["id"]))
-        freq_rel.setdefault(row["rel"], {})[(row["corpus"], row["rel"])] = row["rel_freq"]
-        freq_head_rel.setdefault((head, row["rel"]), {})[(row["corpus"], row["rel"])] = row["head_rel_freq"]
-        freq_rel_dep.setdefault((row["rel"], dep), {})[(row["corpus"], row["rel"])] = row["dep_rel_freq"]
-
-    if corpus is not None:
-        save_cache(corpus, corpus_data)
-        del corpus_data
-
-    cursor.close()
-
-    # Calculate MI
-    for rel in rels:
-        f_rel = sum(freq_rel[rel[1]].values())
-        f_head_rel = sum(freq_head_rel[(rel[0], rel[1])].values())
-        f_rel_dep = sum(freq_rel_dep[(rel[1], rel[2])].values())
-        rels[rel]["mi"] = rels[rel]["freq"] * math.log((f_rel * rels[rel]["freq"]) / (f_head_rel * f_rel_dep * 1.0), 2)
-
-    sortedrels = sorted(rels.items(), key=lambda x: (x[0][1], x[1][sort]), reverse=True)
-
-    for rel in sortedrels:
-        counter.setdefault((rel[0][1], "h"), 0)
-        counter.setdefault((rel[0][1], "d"), 0)
-        if search_type == "lemgram" and rel[0][0][0] == word:
-            counter[(rel[0][1], "h")] += 1
-            if maxresults and counter[(rel[0][1], "h")] > maxresults:
-                continue
-        else:
-            counter[(rel[0][1], "d")] += 1
-            if maxresults and counter[(rel[0][1], "d")] > maxresults:
-                continue
+                if incremental:
+                    yield {"progress_%d" % progress_count: {"corpus": corpus.upper()}}
+                    progress_count += 1
+
+    if not rel_keys:
+        yield result
+        return
 
-        r = {"head": rel[0][0][0],
-             "headpos": rel[0][0][1],
-             "rel": rel[0][1],
-             "dep": rel[0][2][0],
-             "deppos": rel[0][2][1],
-             "depextra": rel[0][2][2],
-             "freq": rel[1]["freq"],
-             "mi": rel[1]["mi"],
-             "source": list(rel[1]["source"])
+    # Calculate MI for all triples at once
+    f_rel_sums = dict((k, sum(v.values())) for k, v in freq_rel.items())
+    f_head_rel_sums = dict((k, sum(v.values())) for k, v in freq_head_rel.items())
+    f_rel_dep_sums = dict((k, sum(v.values())) for k, v in freq_rel_dep.items())
+    # The frequencies are converted to floats before multiplying, as their products could overflow 64-bit integers
+    freqs = numpy.array(rel_freqs, dtype=numpy.float64)
+    f_rel = numpy.array([f_rel_sums[rel] for _, rel, _ in rel_keys], dtype=numpy.float64)
+    f_head_rel = numpy.array([f_head_rel_sums[(head, rel)] for head, rel, _ in rel_keys], dtype=numpy.float64)
+    f_rel_dep = numpy.array([f_rel_dep_sums[(rel, dep)] for _, rel, dep in rel_keys], dtype=numpy.float64)
+    mis = (freqs * (numpy.log((f_rel * freqs) / (f_head_rel * f_rel_dep)) / math.log(2))).tolist()
+    sort_values = mis if sort == "mi" else rel_freqs
+
+    # Keep the top maxresults triples for each relation and direction, ties going to the triple with the first source in
+    # corpus order, so that the result doesn't depend on the order in which the corpus queries complete
+    top = defaultdict(list)
+    for i, (head, rel, _) in enumerate(rel_keys):
+        heap = top[(rel, "h" if search_type == "lemgram" and head[0] == word else "d")]
+        item = (sort_values[i], -min(rel_sources[i]), i)
+        if not maxresults or len(heap) < maxresults:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    selected = sorted((rel_keys[i][1], value, neg_source, i) for heap in top.values() for value, neg_source, i in heap)
+    id_mask = (1 << RELATIONS_SOURCE_ID_BITS) - 1
+    corpus_names = list(corpus_index)
+
+    for _, _, _, i in reversed(selected):
+        head, rel, dep = rel_keys[i]
+        r = {"head": head[0],
+             "headpos": head[1],
+             "rel": rel,
+             "dep": dep[0],
+             "deppos": dep[1],
+             "depextra": dep[2],
+             "freq": rel_freqs[i],
+             "mi": mis[i],
+             "source": ["%s:%d" % (corpus_names[s >> RELATIONS_SOURCE_ID_BITS], s & id_mask)
+                        for s in sorted(set(rel_sources[i]))]
              }
         result.setdefault("relations", []).append(r)
 
     yield result
 
 
+def relations_corpus_worker(selects, add_rows, keep_rows=False, request=None):
+    """Run the word picture queries in selects, pairs of SQL and parameters, for one corpus.
+
+    The rows are passed to add_rows in batches as they are read from the database. If keep_rows is set, all the rows
+    are also returned.
+    """
+    rows = [] if keep_rows else None
+    with sql_pool.connection("relations") as conn:
+        cursor = conn.cursor()
+        sql_execute(cursor, "SET @@session.long_query_time = 1000;", request=request)
+        cursor.close()
+        for sql, params in selects:
+            with contextlib.closing(sql_stream(conn, sql, params, request=request)) as result:
+                while True:
+                    batch = list(itertools.islice(result, config.DBFETCH_SIZE))
+                    if not batch:
+                        break
+                    add_rows(batch)
+                    if keep_rows:
+                        rows.extend(batch)
+    return rows
+
+
+@functools.lru_cache(maxsize=1024)
+def relations_sql(corpus_table, form, minfreq=False):
+    """Return the head and dependent queries for a word picture.
+
+    form is "bf" for lemgram searches and "wf" for word form searches. The queries have placeholders for the corpus
+    name, the searched string and, if minfreq is set, the cut-off frequency.
+    """
+    selects = []
+    for side, other in (("S1", "S2"), ("S2", "S1")):
+        if form == "bf":
+            where = side + ".string = %s COLLATE " + config.DBCOLLATE_LEMGRAM + " AND F.bfhead = 1 AND F.bfdep = 1"
+        else:
+            where = side + ".string = %s AND F.wf" + ("head" if side == "S1" else "dep") + " = 1"
+        if minfreq:
+            where += " AND F.freq >= %s"
+        selects.append(
+            "(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, %s AS corpus, F.id " +
+            "FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
+            "WHERE " + where + " AND F.head = S1.id AND F.dep = S2.id " +
+            "AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)")
+    return selects
+
+
+@functools.lru_cache(maxsize=1024)
+def relations_mi_sql(mi_table, form, minfreq=False, top=0):
+    """Return the head and dependent queries for a word picture using a table created by materialize_relations().
+
+    The queries take the same parameters as the ones from relations_sql(). If top is set, only the top rows by MI for
+    each relation are read.
+    """
+    selects = []
+    for side in ("head", "dep"):
+        if form == "bf":
+            where = side + " = %s COLLATE " + config.DBCOLLATE_LEMGRAM + " AND bfhead = 1 AND bfdep = 1"
+        else:
+            where = side + " = %s AND wf" + side + " = 1"
+        if minfreq:
+            where += " AND freq >= %s"
+        if top:
+            where += " AND (rank_%s_%s <= %d" % (form, side, top)
+            if form == "bf" and side == "dep":
+                # Also read the relations ranked only among head relations, as the non-materialized query does
+                where += " OR BINARY head = BINARY dep"
+            where += ")"
+        selects.append("(SELECT head, headpos, rel, dep, deppos, depextra, freq, rel_freq, head_rel_freq, "
+                       "dep_rel_freq, %s AS corpus, id FROM `" + mi_table + "` WHERE " + where + ")")
+    return selects
+
+
+def materialize_relations(corpus):
+    """Create or replace a table with the word picture relations of corpus joined with their frequencies.
+
+    The table also contains the MI of each relation in the corpus and its rank by MI among the relations with the same
+    head or dependent. /relations then reads the word picture from this single indexed table instead of joining six
+    tables, and for a single corpus reads only the top rows. The table needs to be recreated whenever the word picture
+    tables of the corpus are updated.
+    """
+    corpus_table = config.DBWPTABLE + "_" + corpus.upper()
+    mi_table = corpus_table + "_mi"
+
+    rows_sql = ("SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, "
+                "S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, "
+                "DR.freq AS dep_rel_freq, F.id, F.bfhead, F.bfdep, F.wfhead, F.wfdep, "
+                "F.freq * LOG2((R.freq * F.freq) / (HR.freq * DR.freq)) AS mi "
+                "FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table +
+                "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table +
+                "_dep_rel` AS DR "
+                "WHERE F.head = S1.id AND S2.id = F.dep AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel "
+                "AND F.dep = DR.dep AND F.rel = DR.rel")
+    # A relation where the searched string is both head and dependent is found by both the head and the dependent
+    # query, and its frequency is then counted twice by /relations, so it is ranked by that MI
+    double_mi = "2 * freq * LOG2((2 * rel_freq * freq) / (head_rel_freq * dep_rel_freq))"
+    ranks = []
+    for form in ("bf", "wf"):
+        for side in ("head", "dep"):
+            if form == "bf":
+                condition = "bfhead = 1 AND bfdep = 1"
+                double_condition = "BINARY head = BINARY dep"
+                if side == "dep":
+                    # In lemgram searches, such relations are counted as head relations, so they must not take up
+                    # room among the top dependent relations
+                    condition += " AND BINARY head <> BINARY dep"
+            else:
+                condition = "wf%s = 1" % side
+                double_condition = "wfhead = 1 AND wfdep = 1 AND BINARY head = BINARY dep"
+            ranks.append("CASE WHEN %s THEN ROW_NUMBER() OVER (PARTITION BY %s, rel, %s "
+                         "ORDER BY CASE WHEN %s THEN %s ELSE mi END DESC, id) END AS rank_%s_%s" % (
+                             condition, side, condition, double_condition, double_mi, form, side))
+
+    with sql_pool.connection() as conn:
+        cursor = conn.cursor()
+        # Build the new table under a temporary name and swap it in atomically
+        cursor.execute("DROP TABLE IF EXISTS `%s_new`;" % mi_table)
+        cursor.execute("CREATE TABLE `%s_new` (INDEX (head, rel), INDEX (dep, rel)) SELECT M.*, %s FROM (%s) AS M;" % (
+            mi_table, ", ".join(ranks), rows_sql))
+        cursor.execute("SHOW TABLES LIKE '%s';" % mi_table.replace("_", "\\_"))
+        if cursor.fetchall():
+            cursor.execute("DROP TABLE IF EXISTS `%s_old`;" % mi_table)
+            cursor.execute("RENAME TABLE `%s` TO `%s_old`, `%s_new` TO `%s`;" % (mi_table, mi_table, mi_table,
+                                                                                 mi_table))
+            cursor.execute("DROP TABLE `%s_old`;" % mi_table)
+        else:
+            cursor.execute("RENAME TABLE `%s_new` TO `%s`;" % (mi_table, mi_table))
+        cursor.close()
+
+    invalidate_wp_tables()
+
+
 ################################################################################
 # RELATIONS_SENTENCES
 ################################################################################
@@ -3068,15 +4578,15 @@ def relations_sentences(args):
 
     querystarttime = time.time()
 
-    with app.app_context():
-        cursor = mysql.connection.cursor()
+    with sql_pool.connection("relations_sentences") as conn:
+        cursor = conn.cursor()
         sql_execute(cursor, "SET @@session.long_query_time = 1000;")
         selects = []
         counts = []
+        params = []
 
         # Get available tables
-        sql_execute(cursor, "SHOW TABLES LIKE '" + config.DBWPTABLE + "_%';")
-        tables = set(list(x.values())[0] for x in cursor)
+        tables = get_wp_tables(cursor)
         # Filter out corpora which doesn't exist in database
         source = sorted([x for x in iter(source.items()) if config.DBWPTABLE + "_" + x[0].upper() in tables])
         if not source:
@@ -3091,30 +4601,26 @@ def relations_sentences(args):
 
             corpus_table_sentences = config.DBWPTABLE + "_" + corpus.upper() + "_sentences"
 
-            selects.append("(SELECT S.sentence, S.start, S.end, '" + sql_escape(corpus.upper()) + "' AS corpus " +
+            selects.append("(SELECT S.sentence, S.start, S.end, %s AS corpus " +
                            "FROM `" + corpus_table_sentences + "` as S " +
                            " WHERE S.id IN " + ids_list + ")"
                            )
-            counts.append("(SELECT '" + sql_escape(corpus.upper()) + "' AS corpus, COUNT(*) AS freq FROM `" +
+            counts.append("(SELECT %s AS corpus, COUNT(*) AS freq FROM `" +
                           corpus_table_sentences + "` as S WHERE S.id IN " + ids_list + ")")
+            params.append(corpus.upper())
 
-        sql_count = " UNION ALL ".join(counts)
-        sql_execute(cursor, sql_count)
+        cursor.close()
 
+        sql_count = " UNION ALL ".join(counts)
         corpus_hits = {}
-        for row in cursor:
-            corpus_hits[row["corpus"]] = int(row["freq"])
+        for corpus, freq in sql_stream(conn, sql_count, params):
+            corpus_hits[corpus] = int(freq)
 
         sql = " UNION ALL ".join(selects) + (" LIMIT %d, %d" % (start, end - start + 1))
-        sql_execute(cursor, sql)
-
-        querytime = time.time() - querystarttime
         corpora_dict = {}
-        for row in cursor:
-            corpora_dict.setdefault(row["corpus"], {}).setdefault(row["sentence"], []).append(
-                (row["start"], row["end"]))
-
-        cursor.close()
+        for sentence, start_pos, end_pos, corpus in sql_stream(conn, sql, params):
+            corpora_dict.setdefault(corpus, {}).setdefault(sentence, []).append((start_pos, end_pos))
+        querytime = time.time() - querystarttime
 
     total_hits = sum(corpus_hits.values())
 
@@ -3125,36 +4631,37 @@ def relations_sentences(args):
     cqpstarttime = time.time()
     result = {}
 
-    for corp, sids in sorted(corpora_dict.items(), key=lambda x: x[0]):
-        cqp = u'<sentence_id="%s"> []* </sentence_id> within sentence' % "|".join(set(sids.keys()))
-        q = {"cqp": cqp,
-             "corpus": corp,
-             "start": "0",
-             "end": str(end - start),
-             "show_struct": ["sentence_id"] + list(shown_structs),
-             "default_context": default_context}
-        if shown:
-            q["show"] = shown
-        result_temp = generator_to_dict(query(q))
-
-        # Loop backwards since we might be adding new items
-        for i in range(len(result_temp["kwic"]) - 1, -1, -1):
-            s = result_temp["kwic"][i]
-            sid = s["structs"]["sentence_id"]
-            r = sids[sid][0]
+    # Look up the sentences of all corpora in parallel, each corpus with a query for its own sentence IDs, returning
+    # one row per sentence
+    show = shown.split(QUERY_DELIM) if isinstance(shown, str) else list(shown)
+    queryparams = {"within": None,
+                   "context": (default_context,),
+                   "show": set(show + ["word"]),
+                   "show_structs": set(["sentence_id"]) | shown_structs,
+                   "start": 0,
+                   "use_cache": args["cache"]}
+    with ThreadPoolExecutor(max_workers=config.PARALLEL_THREADS) as executor:
+        future_query = {}
+        for corpus, sids in sorted(corpora_dict.items()):
+            max_rows = len(sids)
+            if config.MAX_KWIC_ROWS:
+                max_rows = min(max_rows, config.MAX_KWIC_ROWS)
+            cqp = [u'<sentence_id="%s"> []* </sentence_id> within sentence' % "|".join(sorted(sids))]
+            future_query[corpus] = executor.submit(query_and_parse, corpus, cqp, end=max_rows - 1,
+                                                   request=request._get_current_object(), **queryparams)
+
+    result["kwic"] = []
+    for corpus, future in future_query.items():
+        corpus_kwic, _ = future.result()
+        for s in corpus_kwic:
             sentence_start = s["match"]["start"]
-            s["match"]["start"] = sentence_start + min(map(int, r)) - 1
-            s["match"]["end"] = sentence_start + max(map(int, r))
 
-            # If the same relation appears more than once in the same sentence,
-            # append copies of the sentence as separate results
-            for r in sids[sid][1:]:
-                s2 = deepcopy(s)
-                s2["match"]["start"] = sentence_start + min(map(int, r)) - 1
-                s2["match"]["end"] = sentence_start + max(map(int, r))
-                result_temp["kwic"].insert(i + 1, s2)
-
-        result.setdefault("kwic", []).extend(result_temp["kwic"])
+            # If the same relation appears more than once in the same sentence, add a result for each, sharing the
+            # tokens and structural attributes of the sentence
+            for r in corpora_dict[corpus][s["structs"]["sentence_id"]]:
+                result["kwic"].append(dict(s, match=dict(s["match"],
+                                                         start=sentence_start + min(map(int, r)) - 1,
+                                                         end=sentence_start + max(map(int, r)))))
 
     result["hits"] = total_hits
     result["corpus_hits"] = corpus_hits
@@ -3165,6 +4672,120 @@ def relations_sentences(args):
     yield result
 
 
+################################################################################
+# BATCH
+################################################################################
+
+# Commands that can be run in a /batch request
+BATCH_COMMANDS = ("info", "corpus_info", "query", "query_sample", "count", "count_all", "count_time", "loglike",
+                  "lemgram_count", "timespan", "relations", "relations_sentences", "struct_values")
+
+
+@app.route("/batch", methods=["GET", "POST"])
+@main_handler
+@prevent_timeout
+def batch(args):
+    """Run several commands concurrently, and return the result of each command as soon as it is finished.
+
+    The parameter "requests" is a list of objects (or a JSON string of one), each with the name of a command in
+    "command" and the parameters of the command. The other parameters of the batch request are used as defaults for all
+    the commands. The result of a command is under its "id", or its index in the list if it has none. The commands
+    share the authentication result and the cache versions of the corpora.
+
+    Each command is run as a request to its own endpoint: it goes through the admission control of the endpoint, and
+    the filter_args, filter_result and error plugin hooks are called for it. A command rejected by admission control
+    gets a ServiceUnavailable error as its result.
+    """
+    subrequests = args.get("requests")
+    if isinstance(subrequests, str):
+        try:
+            subrequests = json.loads(subrequests)
+        except ValueError:
+            raise ValueError("Parameter 'requests' is not valid JSON.")
+    if not isinstance(subrequests, list) or not all(isinstance(subrequest, dict) for subrequest in subrequests):
+        raise ValueError("Parameter 'requests' must be a list of objects.")
+
+    common_args = dict((key, value) for key, value in args.items()
+                       if key not in ("requests", "internal", "incremental", "callback", "indent", "format"))
+    jobs = {}
+    for i, subrequest in enumerate(subrequests):
+        command = subrequest.get("command")
+        if command not in BATCH_COMMANDS:
+            raise ValueError("Command %r is not available in a batch." % command)
+        key = str(subrequest.get("id", i))
+        if key in jobs:
+            raise ValueError("Duplicate id %r in batch." % key)
+        if key in ("time", "ERROR"):
+            # Used in the result of the batch request itself
+            raise ValueError("The id %r is reserved." % key)
+        subargs = dict(common_args)
+        subargs.update((k, v) for k, v in subrequest.items() if k not in ("command", "id"))
+        # Numbers and booleans in JSON become strings, as in a query string
+        jobs[key] = (command, dict((k, batch_arg(v)) for k, v in subargs.items()))
+
+    if args["cache"]:
+        # Read the cache versions of all corpora at once
+        load_cache_versions(set(corpus for _, subargs in jobs.values() for corpus in parse_corpora(subargs)))
+
+    # The memoized values are shared by the commands through the environment of the batch request, copied for each
+    # command along with the cache versions and the request headers
+    request.environ.setdefault("korp.memo", {})
+    request.environ.setdefault("korp.memo_lock", threading.Lock())
+    batch_environ = request.environ
+
+    def run_command(command, subargs):
+        environ = dict(batch_environ, PATH_INFO="/" + command, QUERY_STRING="", REQUEST_METHOD="GET",
+                       CONTENT_LENGTH="0")
+        environ["wsgi.input"] = io.BytesIO()
+        with app.request_context(environ):
+            plugin_caller = korppluginlib.KorpCallbackPluginCaller()
+            try:
+                result = run_batch_command(command, subargs, plugin_caller)
+                return plugin_caller.filter_value("filter_result", result)
+            finally:
+                plugin_caller.cleanup()
+
+    with ThreadPoolExecutor(max_workers=config.PARALLEL_THREADS) as executor:
+        future_query = dict((executor.submit(run_command, command, subargs), key)
+                            for key, (command, subargs) in jobs.items())
+
+        for future in futures.as_completed(future_query):
+            yield {future_query[future]: future.result()}
+
+
+def batch_arg(value):
+    """Return a scalar argument of a /batch command as a string, the way the commands get their arguments."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+
+def run_batch_command(command, args, plugin_caller):
+    """Run command with args in the request context of the command, as main_handler would, and return the result."""
+    try:
+        args = plugin_caller.filter_value("filter_args", args)
+        limiter = get_admission_limiter(command)
+        slots = 0
+        if limiter:
+            slots = limiter.acquire(request_cost(args))
+            if not slots:
+                return admission_error(request.path)
+        try:
+            return generator_to_dict(app.view_functions[command](args))
+        finally:
+            if slots:
+                limiter.release(slots)
+    except Exception as e:
+        exc = sys.exc_info()
+        error = {"ERROR": {"type": type(e).__name__, "value": str(e)}}
+        if "debug" in args:
+            error["ERROR"]["traceback"] = "".join(traceback.format_exception(*exc)).splitlines()
+        plugin_caller.raise_event("error", error, exc)
+        return error
+
+
 ################################################################################
 # CACHE HANDLING
 ################################################################################
@@ -3174,6 +4795,10 @@ def relations_sentences(args):
 @prevent_timeout
 def cache_handler(args):
     """Check for updated corpora and invalidate caches where needed. Also remove old disk cache."""
+    # The word picture tables and lemgram frequencies may have changed along with the corpora
+    invalidate_wp_tables()
+    invalidate_lemgram_indexes()
+
     if not config.CACHE_DIR or not config.MEMCACHED_SERVERS or cache_disabled:
         return {}
 
@@ -3248,8 +4873,36 @@ def cache_handler(args):
 
 
 def cache_prefix(corpus="multi", config=False):
+    key = f"{corpus}:version{'_config' if config else ''}"
+    versions = request.environ.get("korp.cache_versions") if has_request_context() else None
+    if versions and key in versions:
+        return "%s:%d" % (corpus, versions[key])
     with mc_pool.reserve() as mc:
-        return "%s:%d" % (corpus, mc.get(f"{corpus}:version{'_config' if config else ''}", 0))
+        return "%s:%d" % (corpus, mc.get(key, 0))
+
+
+def load_cache_versions(corpora):
+    """Read the cache versions of corpora (and the common ones) for the rest of the current request.
+
+    The versions are used by cache_prefix instead of reading them separately from Memcached.
+    """
+    keys = ["%s:version%s" % (corpus, suffix) for corpus in ["multi"] + sorted(corpora) for suffix in ("", "_config")]
+    with mc_pool.reserve() as mc:
+        versions = mc.get_multi(keys)
+    request.environ["korp.cache_versions"] = dict((key, versions.get(key, 0)) for key in keys)
+
+
+def get_corpus_version(corpus, use_cache=False):
+    """Return a value identifying the current version of a corpus, for data kept in-process.
+
+    The value combines the modification time of the registry file and, if caching is used, the cache version.
+    """
+    corpus = corpus.split("|")[0]
+    try:
+        mtime = os.path.getmtime(os.path.join(config.CWB_REGISTRY, corpus.lower()))
+    except OSError:
+        mtime = 0
+    return mtime, cache_prefix(corpus) if use_cache else None
 
 
 def get_corpus_timestamps():
@@ -3439,10 +5092,10 @@ def run_cqp(command, encoding=None, executable=config.CQP_EXECUTABLE,
     command = "set PrettyPrint off;\n" + command
     command = command.encode(encoding)
     command = plugin_caller.filter_value("filter_cqp_input", command)
-    process = subprocess.Popen([executable, "-c", "-r", registry],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE, env=env)
+    process = popen([executable, "-c", "-r", registry],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, env=env)
     reply, error = process.communicate(command)
     reply, error = plugin_caller.filter_value(
         "filter_cqp_output", (reply, error))
@@ -3479,23 +5132,34 @@ def run_cwb_scan(corpus, attrs, encoding=config.CQP_ENCODING, executable=config.
                  registry=config.CWB_REGISTRY):
     """Call the cwb-scan-corpus binary with the given arguments.
     Yield one result line at the time, disregarding empty lines.
-    If there is an error, raise a CQPError exception.
+    If there is an error, raise a CQPError exception as soon as it is noticed.
     """
-    process = subprocess.Popen([executable, "-q", "-r", registry, corpus] + attrs,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    reply, error = process.communicate()
+    # Errors are written to a temporary file, so that the process can't block on a full stderr pipe while we are
+    # reading stdout
+    with tempfile.TemporaryFile() as errors:
+        process = popen([executable, "-q", "-r", registry, corpus] + attrs,
+                        stdout=subprocess.PIPE, stderr=errors)
+        try:
+            # Stream the output instead of reading it all into memory. Iterating over the binary stream only splits
+            # on "\n", unlike splitlines(), which might split on special characters in the data.
+            for i, line in enumerate(process.stdout):
+                if i % 10000 == 0 and os.fstat(errors.fileno()).st_size:
+                    break
+                line = line.rstrip(b"\n").decode(encoding, errors="ignore")
+                if line and len(line) < 65536:
+                    yield line
+        finally:
+            if process.poll() is None:
+                # The output was not read to the end
+                process.kill()
+            process.stdout.close()
+            process.wait()
+        errors.seek(0)
+        error = errors.read()
     if error:
         # Remove newlines from the error string:
         error = re.sub(r"\s+", r" ", error.decode())
-        # Ignore certain errors:
-        # 1) "show +attr" for unknown attr,
-        # 2) querying unknown structural attribute,
-        # 3) calculating statistics for empty results
         raise CQPError(error)
-    for line in reply.decode(encoding, errors="ignore").split(
-            "\n"):  # We don't use splitlines() since it might split on special characters in the data
-        if line and len(line) < 65536:
-            yield line
 
 
 def show_attributes():
@@ -3587,6 +5251,7 @@ def authenticate(_=None):
 
 @app.route("/corpus_config", methods=["GET", "POST"])
 @main_handler
+@use_etag(corpus_config_versions)
 def corpus_config(args):
     """Get corpus configuration for a given mode or list of corpora. To be used by the Korp frontend.
 
@@ -4027,13 +5692,25 @@ def check_authentication(corpora):
         corpora = [cc for c in corpora for cc in c.split("|")]
         c = [c for c in corpora if c.upper() in protected]
         if c:
-            auth = generator_to_dict(authenticate({}))
+            auth = request_memo("authentication", lambda: generator_to_dict(authenticate({})))
             unauthorized = [x for x in c if x.upper() not in auth.get("corpora", [])]
             if not auth or unauthorized:
                 raise KorpAuthenticationError("You do not have access to the following corpora: %s" %
                                               ", ".join(unauthorized))
 
 
+def request_memo(key, func):
+    """Return the value of func() for the current request, calling func only once per request.
+
+    The value is also shared by the commands of a /batch request.
+    """
+    memo = request.environ.setdefault("korp.memo", {})
+    with request.environ.setdefault("korp.memo_lock", threading.Lock()):
+        if key not in memo:
+            memo[key] = func()
+    return memo[key]
+
+
 def get_protected_corpora():
     """Return a list of protected corpora."""
     protected = []
@@ -4082,6 +5759,38 @@ if config.MEMCACHED_SERVERS and not cache_disabled:
 # Set up caching
 setup_cache()
 
+# Set up database connection pool
+sql_pool = SQLConnectionPool(config.DBPOOL_SIZE, max_lifetime=config.DBPOOL_MAX_LIFETIME,
+                             host=config.DBHOST, port=config.DBPORT, user=config.DBUSER, passwd=config.DBPASSWORD,
+                             db=config.DBNAME, charset=config.DBCHARSET, use_unicode=True, autocommit=True,
+                             connect_timeout=config.DBCONNECT_TIMEOUT, cursorclass=MySQLdb.cursors.DictCursor)
+
+
+def prewarm_sql_pool():
+    """Open DBPOOL_PREWARM database connections in advance."""
+    if config.DBNAME and config.DBPOOL_PREWARM:
+        try:
+            sql_pool.prewarm(config.DBPOOL_PREWARM)
+        except MySQLdb.Error:
+            print("Could not connect to the database. Database connections will be opened on demand.")
+
+
+prewarm_sql_pool()
+
+# Set up the thread pool for long-running requests
+worker_pool = WorkerPool(config.WORKER_THREADS)
+
+# The sort keys of /query with global_sort are compared with the collation used by CQP, or by code point if the locale
+# is not available. Only check that it is available here, leaving the process-wide setting as it was.
+with collate_lock:
+    previous_collate = locale.setlocale(locale.LC_COLLATE)
+    try:
+        locale.setlocale(locale.LC_COLLATE, config.LC_COLLATE)
+    except locale.Error:
+        print("Could not set the locale %s. Sort keys will be compared by code point." % config.LC_COLLATE)
+    finally:
+        locale.setlocale(locale.LC_COLLATE, previous_collate)
+
 
 # Load plugins
 korppluginlib.load(
@@ -4098,6 +5807,8 @@ korppluginlib.load(
              "app",
              "mysql",
              "mc_pool",
+             "sql_pool",
+             "worker_pool",
              # Constants
              "KORP_VERSION",
              "END_OF_LINE",
@@ -4125,10 +5836,161 @@ korppluginlib.load(
      ))
 
 
+################################################################################
+# SERVER PROCESSES
+################################################################################
+
+def serve_prefork(workers, max_requests=0):
+    """Serve the app with gevent in the given number of forked worker processes sharing one listening socket.
+
+    Configuration, plugins and everything else set up when this module is imported are loaded only once, in this master
+    process, and inherited by the workers. A worker exiting is replaced with a new one, and a worker exits after
+    serving max_requests requests (0 = no limit). A worker that crashes soon after starting is replaced only after a
+    delay, doubling with each such crash up to WORKER_RESTART_DELAY_MAX seconds. SIGHUP gracefully replaces all workers
+    with new ones (changes to the code or configuration still require a restart), and SIGTERM or SIGINT stops the
+    server. Workers stopping let their requests in progress finish, waiting at most WSGI_GRACEFUL_TIMEOUT seconds.
+    """
+    listener = socket.socket(socket.AF_INET6 if ":" in config.WSGI_HOST else socket.AF_INET)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((config.WSGI_HOST, config.WSGI_PORT))
+    listener.listen(socket.SOMAXCONN)
+    # Connections must not be shared by the processes, so each worker opens its own
+    sql_pool.close_idle()
+
+    # Worker pids and their start times
+    workers_running = {}
+    workers_retiring = set()
+    signals = []
+    # Number of crashed workers waiting to be restarted, and when
+    restarts_pending = 0
+    restart_delay = 0
+    restart_time = 0
+
+    # The workers are managed with the original, blocking functions, as gevent's versions would reap the exited workers
+    # in the background when the hub runs
+    fork, waitpid, sleep = (gevent.monkey.get_original(module, name)
+                            for module, name in (("os", "fork"), ("os", "waitpid"), ("time", "sleep")))
+
+    def start_worker():
+        pid = fork()
+        if pid == 0:
+            gevent.reinit()
+            try:
+                serve_worker(listener, max_requests)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        workers_running[pid] = time.time()
+
+    def handle_signal(signum, _frame):
+        signals.append(signum)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, handle_signal)
+    for _ in range(workers):
+        start_worker()
+    print("Serving using gevent in %d processes" % workers)
+
+    stopping = False
+    while workers_running or (restarts_pending and not stopping):
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and not stopping:
+                print("Replacing worker processes")
+                old_workers = set(workers_running)
+                for _ in range(workers):
+                    start_worker()
+                restarts_pending = 0
+            else:
+                stopping = True
+                old_workers = set(workers_running)
+            for pid in old_workers:
+                workers_retiring.add(pid)
+                os.kill(pid, signal.SIGTERM)
+        try:
+            pid, status = waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            # All workers have crashed and wait to be restarted
+            pid = 0
+        if not pid:
+            if restarts_pending and not stopping and time.time() >= restart_time:
+                for _ in range(restarts_pending):
+                    start_worker()
+                restarts_pending = 0
+            sleep(0.5)
+            continue
+        start_time = workers_running.pop(pid)
+        if pid in workers_retiring:
+            workers_retiring.discard(pid)
+        elif not stopping:
+            if status == 0:
+                # Recycled after max_requests
+                start_worker()
+            else:
+                if time.time() - start_time < WORKER_RESTART_DELAY_MAX:
+                    restart_delay = min(max(restart_delay * 2, 1), WORKER_RESTART_DELAY_MAX)
+                else:
+                    restart_delay = 0
+                print("Worker process %d crashed, restarting in %d seconds" % (pid, restart_delay))
+                restarts_pending += 1
+                restart_time = time.time() + restart_delay
+    listener.close()
+
+
+def serve_worker(listener, max_requests=0):
+    """Serve requests from listener in a worker process forked by serve_prefork, until stopped with SIGTERM or after
+    max_requests requests (0 = no limit)."""
+    global mc_pool
+    # The master process handles SIGINT and SIGHUP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Set up the resources that must not be shared with the other processes
+    if config.MEMCACHED_SERVERS and not cache_disabled:
+        mc_pool = pylibmc.ClientPool(pylibmc.Client(config.MEMCACHED_SERVERS), config.MEMCACHED_POOL_SIZE or 1)
+        # Plugins get the pool through app_globals
+        korppluginlib.app_globals.mc_pool = mc_pool
+    prewarm_sql_pool()
+
+    requests_left = max_requests
+
+    def wsgi_app(environ, start_response):
+        nonlocal requests_left
+        if max_requests:
+            requests_left -= 1
+            if requests_left == 0:
+                gevent.spawn(stop)
+        return app.wsgi_app(environ, start_response)
+
+    def stop():
+        # Stop accepting connections, and wait for the requests in progress
+        server.stop(timeout=config.WSGI_GRACEFUL_TIMEOUT)
+
+    server = WSGIServer(listener, wsgi_app, spawn=Pool())
+    gevent.signal_handler(signal.SIGTERM, gevent.spawn, stop)
+    server.serve_forever()
+
+
 if __name__ == "__main__":
-    if len(sys.argv) == 2 and sys.argv[1] == "dev":
+    if len(sys.argv) > 2 and sys.argv[1] == "materialize_relations":
+        # Precompute word picture data for the given corpora
+        for corpus in sys.argv[2:]:
+            print("Materializing relations for %s" % corpus.upper())
+            materialize_relations(corpus)
+    elif len(sys.argv) > 2 and sys.argv[1] == "build_timedata":
+        # Build the local timedata store for the given corpora, from the database or with --cwb from the corpora
+        from_cwb = "--cwb" in sys.argv[2:]
+        for corpus in sys.argv[2:]:
+            if corpus != "--cwb":
+                print("Building timedata for %s" % corpus.upper())
+                build_timedata_store(corpus, from_cwb=from_cwb)
+    elif len(sys.argv) == 2 and sys.argv[1] == "dev":
         # Run using Flask (use only for development)
         app.run(debug=True, threaded=True, host=config.WSGI_HOST, port=config.WSGI_PORT)
+    elif config.WSGI_WORKERS > 1 or config.WSGI_MAX_REQUESTS:
+        # Run using gevent in several processes
+        serve_prefork(max(config.WSGI_WORKERS, 1), config.WSGI_MAX_REQUESTS)
     else:
         # Run using gevent
         print("Serving using gevent")
@@ -139,6 +139,16 @@ class KorpCallbackPluginCaller:
         # Remove self from _instances
         del self._instances[id(self._request)]
 
+    def has_callbacks(self, hook_point):
+        """Return True if there are callbacks for hook_point.
+
+        Callback methods in plugin classes whose applies_to method
+        returns false for the current request are not counted.
+        """
+        return any(applies_to(self._request)
+                   for _, applies_to in (KorpCallbackPlugin
+                                         ._callbacks.get(hook_point, [])))
+
     def raise_event(self, hook_point, *args, **kwargs):
         """Raise the event hook_point, discarding callback return values.
 
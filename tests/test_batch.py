@@ -0,0 +1,62 @@
+"""Tests for the /batch endpoint.
+
+The tests need korp.py to be importable, i.e. a config.py and the required packages.
+"""
+
+import json
+import os
+import re
+
+import pytest
+import yaml
+
+korp = pytest.importorskip("korp")
+
+API_YAML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "docs", "api.yaml")
+
+
+def batch_example():
+    """Return the example request in the documentation of /batch."""
+    with open(API_YAML) as f:
+        api = yaml.safe_load(f)
+    description = api["paths"]["/batch"]["get"]["description"]
+    return json.loads(re.search(r"```\n(.*?)```", description, re.S).group(1))
+
+
+@korp.main_handler
+def checked_command(args):
+    """Stand-in for the commands of the example, checking the arguments as /query does."""
+    korp.assert_key("corpus", args, korp.IS_IDENT, True)
+    korp.assert_key("start", args, korp.IS_NUMBER)
+    korp.assert_key("end", args, korp.IS_NUMBER)
+    yield {"args": dict((key, args[key]) for key in ("corpus", "start", "end", "granularity") if key in args)}
+
+
+def test_documented_example(monkeypatch):
+    example = batch_example()
+    for subrequest in example["requests"]:
+        monkeypatch.setitem(korp.app.view_functions, subrequest["command"], checked_command)
+
+    response = korp.app.test_client().post("/batch", json=example)
+    result = json.loads(response.get_data(as_text=True))
+
+    assert "ERROR" not in result
+    assert result["kwic"] == {"args": {"corpus": "ROMI", "start": "0", "end": "9"}}
+    assert result["timespan"] == {"args": {"corpus": "ROMI", "granularity": "y"}}
+
+
+def test_scalar_arguments():
+    assert korp.batch_arg(0) == "0"
+    assert korp.batch_arg(1.5) == "1.5"
+    assert korp.batch_arg(True) == "true"
+    assert korp.batch_arg(False) == "false"
+    assert korp.batch_arg("ROMI") == "ROMI"
+    assert korp.batch_arg(["a", "b"]) == ["a", "b"]
+
+
+def test_reserved_id(monkeypatch):
+    monkeypatch.setitem(korp.app.view_functions, "query", checked_command)
+    response = korp.app.test_client().post("/batch", json={"corpus": "ROMI", "requests": [
+        {"command": "query", "id": "time"}]})
+    result = json.loads(response.get_data(as_text=True))
+    assert result["ERROR"]["type"] == "ValueError"